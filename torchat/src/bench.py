@@ -0,0 +1,332 @@
+# -*- coding: UTF-8 -*-
+
+##############################################################################
+#                                                                            #
+# Copyright (c) 2007-2010 Bernd Kreuss <prof7bit@gmail.com>                  #
+#                                                                            #
+# This program is licensed under the GNU General Public License V3,          #
+# the full source code is included in the binary distribution.               #
+#                                                                            #
+# Included in the distribution are files from other open source projects:    #
+# - TOR Onion Router (c) The Tor Project, 3-clause-BSD                       #
+# - SocksiPy (c) Dan Haim, BSD Style License                                 #
+# - Gajim buddy status icons (c) The Gajim Team, GNU GPL                     #
+#                                                                            #
+##############################################################################
+
+# Micro benchmarks for the performance critical parts of tc_client.
+# Run this from within the src directory:
+#
+#   python bench.py               runs all benchmarks
+#   python bench.py framer        runs only the named benchmark(s)
+#
+# The results are written directly to the console, the log output of
+# the client library still goes through the LogWriter (and its log level)
+
+import os
+import sys
+import time
+import glob
+import random
+import socket
+import hashlib
+import threading
+
+# the arguments are the names of the benchmarks. config must not see
+# them, it would take the first one as the name of a profile
+# (like in torchat.py) and create and use a new data directory for it
+BENCHMARK_NAMES = sys.argv[1:]
+del sys.argv[1:]
+
+import config
+import tc_client
+import tc_codec
+
+def report(text):
+    config.log_writer.stdout.write(text + "\n")
+    config.log_writer.stdout.flush()
+
+def timeIt(function, min_time=0.5):
+    """call function() repeatedly for at least min_time
+    seconds and return the average time per call"""
+    count = 0
+    start = time.time()
+    while True:
+        function()
+        count += 1
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return elapsed / count
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def randomLine(size):
+    """a filedata line with a payload of size random bytes"""
+    data = os.urandom(size)
+    return "filedata 1234 0 %s %s\n" % ("0" * 32, tc_client.encodeLF(data))
+
+
+#--- ### line framing
+
+def legacyFramer(chunks):
+    """the Receiver.run() line splitting before LineFramer existed"""
+    lines = []
+    readbuffer = ""
+    for recv in chunks:
+        readbuffer = readbuffer + recv
+        temp = readbuffer.split("\n")
+        readbuffer = temp.pop()
+        lines.extend(temp)
+    return lines
+
+def lineFramer(chunks):
+    lines = []
+    framer = tc_client.LineFramer()
+    for recv in chunks:
+        lines.extend(framer.feed(recv))
+    return lines
+
+def benchFramer():
+    report("line framing, 4096 byte chunks from recv()")
+    for size in [8192, 65536, 1048576]:
+        line = randomLine(size)
+        chunks = chunked(line, 4096)
+        assert legacyFramer(chunks) == lineFramer(chunks) == [line[:-1]]
+        t_old = timeIt(lambda: legacyFramer(chunks))
+        t_new = timeIt(lambda: lineFramer(chunks))
+        report("%8i byte lines: legacy %8.1f MB/s, LineFramer %8.1f MB/s (%.1fx)" \
+            % (size, len(line) / t_old / 1E6, len(line) / t_new / 1E6, t_old / t_new))
+
+
+#--- ### line encoding
+
+def legacyEncode(blob):
+    """encodeLF() before tc_codec existed"""
+    return blob.replace("\\", "\\/").replace("\n", "\\n")
+
+def legacyDecode(line):
+    """decodeLF() before tc_codec existed"""
+    return line.replace("\\n", "\n").replace("\\/", "\\")
+
+def benchCodec():
+    report("line encoding (plain text, text with escapes, file block, avatar, 1MB)")
+    plain = "Hello, how are you? fine. " * 4
+    text = "Hello, how are you?\nfine. C:\\TorChat\\ " * 4
+    for blob in [plain, text, os.urandom(8192), os.urandom(12288), os.urandom(1048576)]:
+        size = len(blob)
+        encoded = legacyEncode(blob)
+        assert tc_codec.encode(blob) == encoded
+        assert tc_codec.decode(encoded) == blob
+        t_old = timeIt(lambda: legacyEncode(blob))
+        t_new = timeIt(lambda: tc_codec.encode(blob))
+        report("%8i bytes encode: legacy %8.1f MB/s, encode %8.1f MB/s" \
+            % (size, size / t_old / 1E6, size / t_new / 1E6))
+        t_old = timeIt(lambda: legacyDecode(encoded))
+        t_new = timeIt(lambda: tc_codec.decode(encoded))
+        report("%8i bytes decode: legacy %8.1f MB/s, decode %8.1f MB/s (%.1fx)" \
+            % (size, size / t_old / 1E6, size / t_new / 1E6, t_old / t_new))
+
+
+#--- ### protocol message dispatch
+
+class FakeConnection(object):
+    """just enough of a connection for constructing incoming messages"""
+    buddy = None
+
+def legacyDispatch(bl, conn, lines):
+    """ProtocolMsgFromLine() before the PROTOCOL_MESSAGES registry existed"""
+    for line in lines:
+        command, encoded = tc_client.splitLine(line)
+        try:
+            Msg = vars(tc_client)["ProtocolMsg_%s" % command]
+        except:
+            Msg = tc_client.ProtocolMsg
+        Msg(bl, conn, command, encoded)
+
+def registryDispatch(bl, conn, lines):
+    for line in lines:
+        tc_client.ProtocolMsgFromLine(bl, conn, line)
+
+def benchDispatch():
+    report("incoming protocol messages, parsed and dispatched to their class")
+    # an uninitialized BuddyList, the messages are only constructed, not executed
+    bl = tc_client.BuddyList.__new__(tc_client.BuddyList)
+    conn = FakeConnection()
+    traffic = [
+        ("status", "status available"),
+        ("message", "message %s" % tc_client.encodeLF("Hello, how are you?\nfine.")),
+        ("filedata", randomLine(8192)[:-1]),
+    ]
+    for name, line in traffic:
+        lines = [line] * 1000
+        t_old = timeIt(lambda: legacyDispatch(bl, conn, lines))
+        t_new = timeIt(lambda: registryDispatch(bl, conn, lines))
+        report("%8s: legacy %10.0f lines/s, registry %10.0f lines/s (%.1fx)" \
+            % (name, len(lines) / t_old, len(lines) / t_new, t_old / t_new))
+
+
+#--- ### filedata parsing
+
+def legacyParseFiledata(line):
+    """splitting and decoding of a filedata line before splitFields() existed"""
+    command, encoded = tc_client.splitLine(line)
+    blob = legacyDecode(encoded)
+    id, text = tc_client.splitLine(blob)
+    start, text = tc_client.splitLine(text)
+    hash, data = tc_client.splitLine(text)
+    return id, int(start), hash, data
+
+def benchFiledata():
+    report("parsing of incoming filedata lines")
+    bl = tc_client.BuddyList.__new__(tc_client.BuddyList)
+    conn = FakeConnection()
+    for size in [8192, 65536, 1048576]:
+        line = randomLine(size)[:-1]
+        msg = tc_client.ProtocolMsgFromLine(bl, conn, line)
+        assert legacyParseFiledata(line) == (msg.id, msg.start, msg.hash, str(msg.data))
+        t_old = timeIt(lambda: legacyParseFiledata(line))
+        t_new = timeIt(lambda: tc_client.ProtocolMsgFromLine(bl, conn, line))
+        report("%8i byte blocks: legacy %8.1f MB/s, splitFields %8.1f MB/s (%.1fx)" \
+            % (size, size / t_old / 1E6, size / t_new / 1E6, t_old / t_new))
+
+
+#--- ### file transfer over loopback
+
+def loopbackReceiver(sock, bl, total):
+    """the receiving end: frame, parse and check every filedata
+    line and answer it with a filedata_ok like FileReceiver does"""
+    framer = tc_client.LineFramer()
+    conn = FakeConnection()
+    received = 0
+    while received < total:
+        data = sock.recv(65536)
+        if not data:
+            break
+        for line in framer.feed(data):
+            msg = tc_client.ProtocolMsgFromLine(bl, conn, line)
+            assert hashlib.md5(msg.data).hexdigest() == msg.hash
+            received += len(msg.data)
+            sock.sendall("filedata_ok %s\n" % tc_client.encodeLF("%s %i" % (msg.id, msg.start)))
+
+def loopbackTransfer(bl, block_size, total):
+    """send total bytes in blocks of block_size over a loopback tcp
+    connection, never more than the smallest SendWindow in flight.
+    Returns the time it took until the last block was confirmed"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, address = listener.accept()
+    listener.close()
+    thread = threading.Thread(target=loopbackReceiver, args=(receiver, bl, total))
+    thread.start()
+
+    window = max(tc_client.SendWindow.FLOOR, 2 * block_size)
+    block = os.urandom(block_size)
+    framer = tc_client.LineFramer()
+    sent = confirmed = 0
+    t_start = time.time()
+    while confirmed < total:
+        while sent < total and sent + block_size - confirmed <= window:
+            hash = hashlib.md5(block).hexdigest()
+            blob = "1234 %i %s %s" % (sent, hash, block)
+            sender.sendall("filedata %s\n" % tc_client.encodeLF(blob))
+            sent += block_size
+        for line in framer.feed(sender.recv(4096)):
+            confirmed += block_size
+    elapsed = time.time() - t_start
+    thread.join()
+    sender.close()
+    receiver.close()
+    return elapsed
+
+def benchTransfer():
+    report("file transfer over a loopback connection (filedata, md5 and filedata_ok)")
+    bl = tc_client.BuddyList.__new__(tc_client.BuddyList)
+    total = 32 * 1048576
+    for size in [8192, 65536, 262144, 1048576]:
+        elapsed = loopbackTransfer(bl, size, total)
+        blocks = total / size
+        report("%8i byte blocks: %8.1f MB/s, %8.0f blocks/s, %8.0f messages/s" \
+            % (size, total / elapsed / 1E6, blocks / elapsed, 2 * blocks / elapsed))
+
+
+#--- ### compression of file blocks
+
+def compressionCorpus():
+    """test files of about 4 MB each, from very compressible
+    to not compressible at all (like archives or jpegs)"""
+    size = 4 * 1048576
+    rnd = random.Random(1)
+    words = "connection buddy message file block status ping pong error timeout".split()
+    lines = []
+    length = 0
+    while length < size:
+        line = "(%i) [tc_client,%i,%s] %s %016x\n" % (rnd.randint(0, 3), rnd.randint(1, 4000),
+            rnd.choice(words), " ".join(rnd.choice(words) for i in range(8)), rnd.getrandbits(64))
+        lines.append(line)
+        length += len(line)
+    log = "".join(lines)[:size]
+    source = "".join(open(name, "rb").read() for name in sorted(glob.glob("*.py")))
+    source = (source * (size / len(source) + 1))[:size]
+    noise = os.urandom(size)
+    mixed = "".join(log[i:i + 1048576] if i % 2097152 else noise[i:i + 1048576] \
+        for i in range(0, size, 1048576))
+    return [("log file", log), ("source code", source), ("mixed", mixed), ("random", noise)]
+
+def compressBlocks(bl, data, block_size, level):
+    """send data through a BlockCompressor and encode it the same way
+    FileSender does. Returns the bytes on the wire and the time it took"""
+    compressor = tc_client.BlockCompressor()
+    compressor.level = level
+    conn = FakeConnection()
+    wire = 0
+    t_start = time.time()
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        hash = hashlib.md5(block).hexdigest()
+        compressed = compressor.compress(block)
+        if compressed is None:
+            line = "filedata %s" % tc_client.encodeLF("1234 %i %s %s" % (start, hash, block))
+        else:
+            line = "filedata_z %s" % tc_client.encodeLF("1234 %i %s %s" % (start, hash, compressed))
+        wire += len(line) + 1
+    elapsed = time.time() - t_start
+    # and check that the receiver gets the original blocks
+    msg = tc_client.ProtocolMsgFromLine(bl, conn, line)
+    assert hashlib.md5(msg.data).hexdigest() == msg.hash
+    return wire, elapsed
+
+def benchCompression():
+    report("compression of 64KB file blocks, goodput is file bytes per second on a link")
+    report("with the given speed, the CPU time of compression and encoding included")
+    bl = tc_client.BuddyList.__new__(tc_client.BuddyList)
+    links = [100 * 1024, 1000 * 1024]
+    for name, data in compressionCorpus():
+        for level in [0, 1, 6, 9]:
+            wire, elapsed = compressBlocks(bl, data, 65536, level)
+            # sending and compressing run at the same time
+            goodput = ["%7.0f KB/s" % (len(data) / max(float(wire) / link, elapsed) / 1024) for link in links]
+            report("%-12s level %i: %5.1f%% on the wire, %6.1f MB/s cpu, goodput %s at 100 KB/s, %s at 1000 KB/s" \
+                % (name, level, 100.0 * wire / len(data), len(data) / elapsed / 1E6, goodput[0], goodput[1]))
+
+
+BENCHMARKS = [
+    ("framer", benchFramer),
+    ("codec", benchCodec),
+    ("dispatch", benchDispatch),
+    ("filedata", benchFiledata),
+    ("transfer", benchTransfer),
+    ("compression", benchCompression),
+]
+
+def main():
+    names = BENCHMARK_NAMES
+    for name, function in BENCHMARKS:
+        if not names or name in names:
+            function()
+            report("")
+
+if __name__ == "__main__":
+    main()
@@ -40,6 +40,9 @@ config_defaults = {
     ("client", "own_hostname") : "0000000000000000",
     ("client", "listen_interface") : "127.0.0.1",
     ("client", "listen_port") : 11009,
+    ("client", "io_engine") : "threads",
+    ("client", "recv_size") : 4096,
+    ("client", "max_line_length") : 4194304,
     ("logging", "log_file") : "",
     ("logging", "log_level") : 0,
     ("logging", "chatlog_path") : "",
@@ -51,6 +54,14 @@ config_defaults = {
     ("files", "dragdropzipdir_command") : 'call "%s" a -r -ep1 "%s" "%s";',
     ("files", "dragdropzipdir_wipezip") : 0,
     ("files", "reconnect_on_timeout") : 0,
+    ("files", "send_window_max") : 4194304,
+    ("files", "block_size_max") : 65536,
+    ("files", "upload_limit") : 0,
+    ("files", "upload_limit_buddy") : 0,
+    ("files", "write_direct") : 1,
+    ("files", "checkpoint_interval") : 5,
+    ("files", "compression_level") : 6,
+    ("files", "reuse_local_files") : 0,
     ("options", "confirm_close_chat") : 0,
     ("options", "enable_chatlogs_globaly") : 0,
     ("options", "clear_cache_on_startup") : 0,
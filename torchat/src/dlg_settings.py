@@ -128,6 +128,11 @@ class Dialog(wx.Dialog):
         dlg.Info(self.p3, lang.DSET_MISC_FILES_DRAGDROPZIPDIR_COMMAND_INFO)
         dlg.Check(self.p3, lang.DSET_MISC_FILES_DRAGDROPZIPDIR_WIPEZIP, ("files", "dragdropzipdir_wipezip"))
         
+        dlg.Separator(self.p3, lang.DSET_FILES_SEP_UPLOAD_TITLE)
+        dlg.Text(self.p3, lang.DSET_FILES_UPLOAD_LIMIT, ("files", "upload_limit"))
+        dlg.Text(self.p3, lang.DSET_FILES_UPLOAD_LIMIT_BUDDY, ("files", "upload_limit_buddy"))
+        dlg.Text(self.p3, lang.DSET_FILES_COMPRESSION_LEVEL, ("files", "compression_level"))
+        
         #4 fit the sizers
         outer_sizer.Fit(self)
         
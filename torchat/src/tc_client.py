@@ -19,17 +19,27 @@
 
 import SocksiPy.socks as socks
 import socket
+import select
+import errno
+import struct
 import threading
 import random
 import time
+import math
 import sys
 import os
 import shutil
 import subprocess
+import bisect
 import tempfile
 import hashlib
+import json
+import mmap
+import collections
+import zlib
 import config
 import version
+import tc_codec
 
 TORCHAT_PORT = 11009 #do NOT change this.
 TOR_CONFIG = "tor" #the name of the active section in the .ini file
@@ -48,6 +58,18 @@ CB_TYPE_LIST_CHANGED = 5
 CB_TYPE_AVATAR = 6
 CB_TYPE_PROFILE = 7
 CB_TYPE_REMOVE = 8
+CB_TYPE_FILE_RESUMED = 9
+
+# the protocol features that are not in every client, a client tells
+# which of them it knows in its capabilities message (clients that don't
+# send one know none of them and must be served the old way)
+CAP_LARGE_BLOCKS = "large_blocks"
+CAP_SELECTIVE_RESEND = "selective_resend" # filedata_error with start and end
+CAP_RESUME = "resume" # filename again and filedata_received
+CAP_FILE_DIGEST = "file_digest" # filedigest
+CAP_COMPRESSION = "compression" # filedata_z
+CAPABILITIES = [CAP_LARGE_BLOCKS, CAP_SELECTIVE_RESEND, CAP_RESUME,
+                CAP_FILE_DIGEST, CAP_COMPRESSION]
 
 tb = config.tb # the traceback function has moved to config
 tb1 = config.tb1
@@ -70,6 +92,24 @@ def splitLine(text):
         b = ""
     return a, b
 
+def splitFields(line, start, count):
+    """find the first count space delimited fields in line, beginning
+    at position start, without splitting (and copying) the rest of the
+    line. Returns the list of decoded fields and the position where the
+    remaining data begins. Missing fields are returned as empty strings.
+    Since the encoding does never produce or consume spaces it is
+    possible to split the still encoded line and decode the parts"""
+    fields = []
+    for i in range(count):
+        end = line.find(" ", start)
+        if end < 0:
+            fields.append(decodeLF(line[start:]))
+            start = len(line)
+        else:
+            fields.append(decodeLF(line[start:end]))
+            start = end + 1
+    return fields, start
+
 def encodeLF(blob):
     """takes a string of 8 bit binary data and encodes 
     it so that there are no 0x0a (LF) bytes anymore"""
@@ -97,12 +137,14 @@ def encodeLF(blob):
     # often referred to as "newline" I call the chunks of
     # encoded data between them "lines" and each "line" is 
     # representing exactly one protocol message.
-    return blob.replace("\\", "\\/").replace("\n", "\\n")
+    #
+    # The actual encoding and decoding is implemented in tc_codec.
+    return tc_codec.encode(blob)
 
 def decodeLF(line):
     """takes the line as it comes from the socket and decodes it to
     the original binary data contained in a string of bytes"""
-    return line.replace("\\n", "\n").replace("\\/", "\\")
+    return tc_codec.decode(line)
     
 
 def createTemporaryFile(file_name):
@@ -184,6 +226,31 @@ class WipeFileThread(threading.Thread):
         else:
             print "(2) file %s does not exist" % self.file_name
 
+def hashFile(file_name):
+    """the sha256 (hex) of the contents of the file"""
+    content = hashlib.sha256()
+    handle = open(file_name, "rb")
+    while True:
+        data = handle.read(1048576)
+        if not data:
+            break
+        content.update(data)
+    handle.close()
+    return content.hexdigest()
+
+def saveJsonFile(file_name, data):
+    """write data as json so that the file is always either the
+    complete old or the complete new version, even if we crash"""
+    tmp_name = file_name + ".tmp"
+    f = open(tmp_name, "w")
+    json.dump(data, f)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    if config.isWindows() and os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(tmp_name, file_name)
+
 def wipeFile(file_name):
     """Wipe a file by first overwriting it with random data,
     synching it to disk and finally unlinking it. For this
@@ -191,6 +258,199 @@ def wipeFile(file_name):
     background and return immediately."""
     WipeFileThread(file_name)
 
+#--- ### Timers
+
+class WheelTimer(object):
+    """the handle returned by TimerWheel.callLater(), it has a
+    cancel() method just like the old threading.Timer objects had"""
+    def __init__(self, wheel, deadline, function, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel(threading.Thread):
+    """One single thread that drives all timers of the client (keepalive,
+    reconnect backoff and the dead connection check). Before there was
+    a new threading.Timer (and therefore a new thread) for every buddy
+    on every timer cycle.
+
+    This is a hashed timing wheel: time is divided into ticks of TICK
+    seconds and every timer is put into the slot (deadline % SLOTS).
+    Inserting and canceling a timer is O(1), on every tick only the
+    timers in one slot need to be looked at, timers that are more than
+    one revolution away simply stay in their slot until their time has
+    come. Timer functions are called from within this thread, so they
+    should not block for a long time."""
+    TICK = 0.5
+    SLOTS = 512
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.slots = [set() for i in range(self.SLOTS)]
+        self.count = 0
+        self.epoch = time.time()
+        self.current = 0 # the last tick that has been processed
+        self.condition = threading.Condition()
+        self.running = True
+        self.start()
+
+    def now(self):
+        return int((time.time() - self.epoch) / self.TICK)
+
+    def callLater(self, delay, function, *args):
+        """call function(*args) after delay seconds (rounded
+        up to the next tick, it will never be called early)"""
+        self.condition.acquire()
+        deadline = int(math.ceil((time.time() + delay - self.epoch) / self.TICK))
+        deadline = max(deadline, self.current + 1)
+        timer = WheelTimer(self, deadline, function, args)
+        self.slots[deadline % self.SLOTS].add(timer)
+        self.count += 1
+        if self.count == 1:
+            # the thread might be sleeping without timeout
+            self.condition.notify()
+        self.condition.release()
+        return timer
+
+    def cancel(self, timer):
+        self.condition.acquire()
+        if timer.active:
+            timer.active = False
+            self.slots[timer.deadline % self.SLOTS].discard(timer)
+            self.count -= 1
+        self.condition.release()
+
+    def stop(self):
+        self.condition.acquire()
+        self.running = False
+        self.condition.notify()
+        self.condition.release()
+
+    def collectExpired(self):
+        """advance the wheel up to the current time and return
+        all timers that have expired in the meantime"""
+        expired = []
+        target = self.now()
+        if target - self.current > self.SLOTS:
+            # we were sleeping for more than a whole revolution,
+            # each slot needs to be looked at only once
+            slots = range(self.SLOTS)
+            self.current = target
+        else:
+            slots = []
+            while self.current < target:
+                self.current += 1
+                slots.append(self.current % self.SLOTS)
+        for index in slots:
+            slot = self.slots[index]
+            for timer in [t for t in slot if t.deadline <= self.current]:
+                slot.discard(timer)
+                timer.active = False
+                self.count -= 1
+                expired.append(timer)
+        return expired
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            if not self.running:
+                self.condition.release()
+                break
+            expired = self.collectExpired()
+            if not expired:
+                if self.count:
+                    timeout = self.epoch + (self.current + 1) * self.TICK - time.time()
+                    self.condition.wait(max(timeout, 0.01))
+                else:
+                    self.condition.wait()
+            self.condition.release()
+
+            for timer in expired:
+                try:
+                    timer.function(*timer.args)
+                except:
+                    tb()
+
+
+#--- ### GUI callbacks
+
+class CallbackQueue(object):
+    """Hands the callbacks of the BuddyList over from the network threads
+    to the GUI thread without ever blocking a network thread. put() has
+    the signature of the callback function the BuddyList expects. When
+    the first callback arrives in an empty queue notify() is called (from
+    the network thread), it must arrange for drain() to be called from
+    the GUI thread (wx.CallAfter). drain() handles the callbacks in
+    batches of BATCH and asks for the next batch with notify() again,
+    so the GUI can process its own events in between.
+
+    Status, avatar, profile and list changes only tell the GUI to look
+    at the buddy again, one of them per buddy and type is enough while
+    it is still waiting. Everything else is kept in order. Should the
+    queue ever grow beyond MAX_SIZE (the GUI thread must be hanging)
+    new callbacks of these coalesced types are dropped and counted.
+    Chat messages, incoming files and the other callbacks are never
+    dropped, they can't be repeated later"""
+
+    BATCH = 50
+    MAX_SIZE = 10000
+    COALESCE = (CB_TYPE_STATUS, CB_TYPE_AVATAR, CB_TYPE_PROFILE, CB_TYPE_LIST_CHANGED)
+
+    def __init__(self, notify):
+        self.notify = notify
+        self.lock = threading.Lock()
+        self.queue = []
+        self.waiting = set() # coalesced callbacks in the queue
+        self.scheduled = False # notify() has been called, drain() will follow
+        self.dropped = 0
+
+    def put(self, callback_type, callback_data):
+        self.lock.acquire()
+        try:
+            if callback_type in self.COALESCE:
+                key = (callback_type, callback_data)
+                if key in self.waiting:
+                    return
+                if len(self.queue) >= self.MAX_SIZE:
+                    self.dropped += 1
+                    if self.dropped % 1000 == 1:
+                        print "(0) CallbackQueue: GUI is not responding, %i status updates dropped" % self.dropped
+                    return
+                self.waiting.add(key)
+            self.queue.append((callback_type, callback_data))
+            wake = not self.scheduled
+            self.scheduled = True
+        finally:
+            self.lock.release()
+        if wake:
+            self.notify()
+
+    def drain(self, handler):
+        """call handler(callback_type, callback_data) for the next batch"""
+        self.lock.acquire()
+        batch = self.queue[:self.BATCH]
+        del self.queue[:self.BATCH]
+        for callback_type, callback_data in batch:
+            if callback_type in self.COALESCE:
+                self.waiting.discard((callback_type, callback_data))
+        more = len(self.queue) > 0
+        self.scheduled = more
+        self.lock.release()
+        for callback_type, callback_data in batch:
+            try:
+                handler(callback_type, callback_data)
+            except:
+                tb()
+        if more:
+            self.notify()
+
+
 #--- ### Client API
 
 class Buddy(object):
@@ -215,11 +475,12 @@ class Buddy(object):
         self.random1 = str(random.getrandbits(256))
         self.random2 = str(random.getrandbits(256))
         self.conn_out = None
-        self.conn_in = None
+        self._conn_in = None
         self.status = STATUS_OFFLINE
         self.last_status = STATUS_OFFLINE
         self.client = ""
         self.version = ""
+        self.capabilities = set()
         self.timer = False
         self.last_status_time = 0
         self.count_failed_connects = 0
@@ -229,6 +490,21 @@ class Buddy(object):
         self.image_idx = 0
         self.startTimer()
 
+    def getConnIn(self):
+        return self._conn_in
+
+    def setConnIn(self, connection):
+        # the BuddyList keeps an index of all active in-connections
+        # so it must be notified about every change
+        # (it also wakes up the file senders, they must already
+        # see the new connection then)
+        if connection is not self._conn_in:
+            old_connection = self._conn_in
+            self._conn_in = connection
+            self.bl.onConnInChanged(self, old_connection, connection)
+
+    conn_in = property(getConnIn, setConnIn)
+
     def connect(self):
         print "(2) %s.connect()" % self.address
         if self.address not in self.bl.blocked_list.list:
@@ -245,6 +521,17 @@ class Buddy(object):
     def isAlreadyPonged(self):
         return self.conn_out and self.conn_out.pong_sent
 
+    def hasCapability(self, capability):
+        """True if the buddy has told us that it knows this protocol
+        feature (see CAPABILITIES)"""
+        return capability in self.capabilities
+
+    def lacksCapability(self, capability):
+        """True only if we know already that the buddy does not know
+        this protocol feature (it has sent its version but the feature
+        was not in its capabilities)"""
+        return self.version != "" and capability not in self.capabilities
+
     def disconnect(self):
         print "(2) %s.disconnect()" % self.address
         if self.conn_out != None:
@@ -254,6 +541,13 @@ class Buddy(object):
             self.conn_in.close()
             self.conn_in = None
         self.onStatus(STATUS_OFFLINE)
+        self.notifyFileSenders()
+
+    def notifyFileSenders(self):
+        #the file senders sleep while they are not connected,
+        #they must be woken up whenever the connection changes
+        for sender in self.bl.getFileSenders(self):
+            sender.onConnectionChanged()
     
     def block(self):
         print "(2) %s.block()" % self.address
@@ -453,8 +747,7 @@ class Buddy(object):
     
             if self.timer:
                 self.timer.cancel()
-            self.timer = threading.Timer(t, self.onTimer)
-            self.timer.start()
+            self.timer = self.bl.timer_wheel.callLater(t, self.onTimer)
         else:
             print "(2) %s is blocked" % self.address
             self.status = STATUS_BLOCKED
@@ -568,6 +861,8 @@ class Buddy(object):
         if self.isAlreadyPonged():
             msg = ProtocolMsg_client(self, version.NAME)
             msg.send()
+            msg = ProtocolMsg_capabilities(self, " ".join(CAPABILITIES))
+            msg.send()
             msg = ProtocolMsg_version(self, version.VERSION)
             msg.send()
         else:
@@ -644,22 +939,48 @@ class BuddyList(object):
     The GUI will instantiate a BuddyList object and this is all
     it needs to do in order to start the client and access 
     all functionality"""
+
+    # finished incoming transfers that are remembered (see file_received)
+    MAX_FILE_RECEIVED = 500
+
     def __init__(self, callback, socket=None):
         print "(1) initializing buddy list"
         self.gui = callback
         self.torctrlcon = None
+        self.timer_wheel = TimerWheel()
         self.blocked_list = BlockedList()
         
         startPortableTor()
 
+        if config.get("client", "io_engine") == "reactor":
+            print "(1) using the single threaded network engine"
+            self.reactor = Reactor()
+        else:
+            self.reactor = None
+
         self.file_sender = {}
         self.file_receiver = {}
+        self.file_received = collections.OrderedDict() # (address, id) -> file_size of finished receivers
+        self.file_received_lock = threading.Lock()
+        self.journal = TransferJournal()
+        self.content_index = ContentIndex()
+        self.transfer_scheduler = TransferScheduler()
+        self.disk_writer = DiskWriter()
 
         #temporary buddies, created from incoming pings with new hostnames
         #these buddies are not yet in the list and if they do not
         #answer and authenticate on the first try they will be deleted
         self.incoming_buddies = []
 
+        #hash indexes for the lookups that are done for every
+        #incoming ping and pong, these must always be updated
+        #together with self.list and self.incoming_buddies
+        self.address_index = {}
+        self.random_index = {}
+        self.incoming_address_index = {}
+        self.incoming_random_index = {}
+        self.conn_in_index = {}
+
         self.listener = Listener(self, socket)
         self.own_status = STATUS_ONLINE
 
@@ -683,13 +1004,13 @@ class BuddyList(object):
                     name = u""
                 buddy = Buddy(address, self, name)
                 self.list.append(buddy)
+                self.indexBuddy(buddy, self.address_index, self.random_index)
 
         found = False
-        for buddy in self.list:
-            if buddy.address == config.get("client", "own_hostname"):
-                found = True
-                self.own_buddy = buddy
-                break
+        buddy = self.getBuddyFromAddress(config.get("client", "own_hostname"))
+        if buddy:
+            found = True
+            self.own_buddy = buddy
 
         if not found:
             print "(1) adding own hostname %s to list" % config.get("client", "own_hostname")
@@ -708,6 +1029,8 @@ class BuddyList(object):
         self.own_avatar_data = ""
         self.own_avatar_data_alpha = ""
 
+        self.resumeFileSenders()
+
         print "(1) BuddList initialized"
     
     def save(self):
@@ -724,13 +1047,49 @@ class BuddyList(object):
     def logMyselfMessage(self, msg):
         self.own_buddy.onChatMessage("*** %s" % msg)
 
+    def indexBuddy(self, buddy, address_index, random_index):
+        address_index.setdefault(buddy.address, buddy)
+        random_index.setdefault(buddy.random1, buddy)
+
+    def unindexBuddy(self, buddy, address_index, random_index):
+        if address_index.get(buddy.address) is buddy:
+            del address_index[buddy.address]
+        if random_index.get(buddy.random1) is buddy:
+            del random_index[buddy.random1]
+
+    def addIncomingBuddy(self, buddy):
+        self.incoming_buddies.append(buddy)
+        self.indexBuddy(buddy, self.incoming_address_index, self.incoming_random_index)
+
+    def removeIncomingBuddy(self, buddy):
+        if self.incoming_address_index.get(buddy.address) is buddy:
+            self.incoming_buddies.remove(buddy)
+            self.unindexBuddy(buddy, self.incoming_address_index, self.incoming_random_index)
+
+    def setBuddyAddress(self, buddy, address):
+        # the address of a buddy on the list must never
+        # be changed without updating the index
+        self.unindexBuddy(buddy, self.address_index, self.random_index)
+        buddy.address = address
+        self.indexBuddy(buddy, self.address_index, self.random_index)
+
+    def isOnList(self, buddy):
+        return self.address_index.get(buddy.address) is buddy
+
+    def onConnInChanged(self, buddy, old_connection, new_connection):
+        if old_connection and self.conn_in_index.get(old_connection) is buddy:
+            del self.conn_in_index[old_connection]
+        if new_connection:
+            self.conn_in_index[new_connection] = buddy
+        buddy.notifyFileSenders()
+
     def addBuddy(self, buddy):
         if self.getBuddyFromAddress(buddy.address) == None:
             self.list.append(buddy)
+            self.indexBuddy(buddy, self.address_index, self.random_index)
             buddy.setTemporary(False)
             buddy.setActive(True)
-            if buddy in self.incoming_buddies:
-                self.incoming_buddies.remove(buddy)
+            self.removeIncomingBuddy(buddy)
             self.save()
             buddy.keepAlive()
             return buddy
@@ -759,6 +1118,7 @@ class BuddyList(object):
         else:
             buddy_to_remove.disconnect()
         self.list.remove(buddy_to_remove)
+        self.unindexBuddy(buddy_to_remove, self.address_index, self.random_index)
         file_name = buddy_to_remove.getOfflineFileName()
         try:
             wipeFile(file_name)
@@ -772,28 +1132,19 @@ class BuddyList(object):
             self.removeBuddy(buddy)
 
     def getBuddyFromAddress(self, address):
-        for buddy in self.list:
-            if buddy.address == address:
-                return buddy
-        return None
+        return self.address_index.get(address)
 
     def getIncomingBuddyFromAddress(self, address):
-        for buddy in self.incoming_buddies:
-            if buddy.address == address:
-                return buddy
-        return None
+        return self.incoming_address_index.get(address)
 
     def getBuddyFromRandom(self, random):
-        for buddy in self.list:
-            if buddy.random1 == random:
-                return buddy
-        return None
+        return self.random_index.get(random)
 
     def getIncomingBuddyFromRandom(self, random):
-        for buddy in self.incoming_buddies:
-            if buddy.random1 == random:
-                return buddy
-        return None
+        return self.incoming_random_index.get(random)
+
+    def getBuddyFromConnIn(self, connection):
+        return self.conn_in_index.get(connection)
 
     def getFileReceiver(self, address, id):
         try:
@@ -801,12 +1152,46 @@ class BuddyList(object):
         except:
             return None
 
+    def addFileReceived(self, address, id, file_size):
+        """remember a finished incoming transfer, a sender that has
+        missed our confirmations can then still get them. Only the
+        last MAX_FILE_RECEIVED of them are kept, oldest go first"""
+        self.file_received_lock.acquire()
+        self.file_received.pop((address, id), None)
+        self.file_received[address, id] = file_size
+        while len(self.file_received) > self.MAX_FILE_RECEIVED:
+            self.file_received.popitem(last=False)
+        self.file_received_lock.release()
+
     def getFileSender(self, address, id):
         try:
             return self.file_sender[address, id]
         except:
             return None
 
+    def resumeFileSenders(self):
+        # the senders will wait until their buddy is connected,
+        # then they ask the receiver what it already has
+        for entry in self.journal.getEntries("send"):
+            buddy = self.getBuddyFromAddress(entry["buddy"])
+            file_name = entry["file_name"]
+            try:
+                unchanged = os.path.getsize(file_name) == entry["file_size"] \
+                    and int(os.path.getmtime(file_name)) == entry["mtime"]
+            except:
+                unchanged = False
+            if buddy and unchanged:
+                print "(2) resuming file transfer of %s to %s" % (file_name, buddy.address)
+                sender = FileSender(buddy, file_name, None, entry)
+                self.gui(CB_TYPE_FILE_RESUMED, sender)
+            else:
+                print "(2) cannot resume file transfer of %s" % file_name
+                self.journal.remove("send", entry["buddy"], entry["id"])
+
+    def getFileSenders(self, buddy):
+        return [sender for (address, id), sender in self.file_sender.items()
+                if address == buddy.address]
+
     def setStatus(self, status):
         self.own_status = status
         for buddy in self.list:
@@ -814,21 +1199,20 @@ class BuddyList(object):
                 buddy.sendStatus()
 
     def onErrorIn(self, connection):
-        for buddy in self.incoming_buddies:
-            if buddy.conn_in == connection:
-                print "(2) in-connection %s of temporary buddy %s failed" % (connection, buddy.address)
-                print "(2) removing buddy instance %s" % buddy.address
-                buddy.setActive(False)
-                buddy.disconnect()
-                if buddy in self.incoming_buddies:
-                    self.incoming_buddies.remove(buddy)
-                break
+        buddy = self.getBuddyFromConnIn(connection)
+        if not buddy:
+            return
 
-        for buddy in self.list:
-            if buddy.conn_in == connection:
-                buddy.disconnect()
-                buddy.onInConnectionFail()
-                break
+        if self.getIncomingBuddyFromAddress(buddy.address) is buddy:
+            print "(2) in-connection %s of temporary buddy %s failed" % (connection, buddy.address)
+            print "(2) removing buddy instance %s" % buddy.address
+            buddy.setActive(False)
+            buddy.disconnect()
+            self.removeIncomingBuddy(buddy)
+
+        elif self.isOnList(buddy):
+            buddy.disconnect()
+            buddy.onInConnectionFail()
 
     def onErrorOut(self, connection):
         buddy = connection.buddy
@@ -837,8 +1221,7 @@ class BuddyList(object):
                 print "(2) out-connection of temporary buddy %s failed" % buddy.address
                 print "(2) removing buddy instance %s" % buddy.address
                 buddy.setActive(False)
-                if buddy in self.incoming_buddies:
-                    self.incoming_buddies.remove(buddy)
+                self.removeIncomingBuddy(buddy)
 
             buddy.disconnect()
             buddy.onOutConnectionFail()
@@ -853,117 +1236,1373 @@ class BuddyList(object):
         for buddy in self.list + self.incoming_buddies:
             buddy.disconnect()
         self.listener.close() #FIXME: does this really work?
+        if self.reactor:
+            self.reactor.stop()
+        self.timer_wheel.stop()
+        self.transfer_scheduler.stop()
+        self.disk_writer.stop()
+        self.journal.stop()
         stopPortableTor()
 
 
+class TransferJournal(threading.Thread):
+    """Remembers the unfinished file transfers in the data dir so they
+    can be resumed when the buddy reconnects or after a restart of
+    either client. There is one entry for every FileSender (the file
+    and how it looked when we started sending it) and every FileReceiver
+    (the temp file and the ranges that are safely written to it). The
+    whole journal is rewritten after every change, it is small. This is
+    done in its own thread so set() and remove() never wait for the disk
+    (they are called from the network threads), changes that come in
+    while it is writing are written together in the next round."""
+
+    FILE_NAME = "file-transfers.json"
+
+    # days after which an unfinished incoming transfer is given up
+    # and its temp file is wiped
+    MAX_AGE = 7
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.file_name = os.path.join(config.getDataDir(), self.FILE_NAME)
+        self.lock = threading.Condition(threading.RLock())
+        self.write_lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.running = True
+        self.load()
+        self.start()
+
+    def load(self):
+        if not os.path.exists(self.file_name):
+            return
+        try:
+            f = open(self.file_name, "r")
+            self.entries = json.load(f)
+            f.close()
+        except:
+            tb()
+            print "(1) could not read the file transfer journal"
+            self.entries = {}
+            return
+
+        expired = time.time() - self.MAX_AGE * 86400
+        for key, entry in self.entries.items():
+            if entry["role"] == "receive" and entry["time"] < expired:
+                print "(2) giving up old incoming file transfer %s" % entry["file_name"]
+                if os.path.exists(entry["tmp"]):
+                    wipeFile(entry["tmp"])
+                del self.entries[key]
+        self.save()
+
+    def save(self):
+        """the journal will be written soon by our own thread"""
+        self.lock.acquire()
+        self.dirty = True
+        self.lock.notify()
+        self.lock.release()
+
+    def write(self):
+        self.write_lock.acquire()
+        try:
+            self.lock.acquire()
+            dirty = self.dirty
+            self.dirty = False
+            entries = dict(self.entries)
+            self.lock.release()
+            if dirty:
+                try:
+                    saveJsonFile(self.file_name, entries)
+                except:
+                    tb()
+                    print "(1) could not write the file transfer journal"
+        finally:
+            self.write_lock.release()
+
+    def stop(self):
+        """write what has not been written yet, this returns
+        when the journal on the disk is up to date"""
+        self.lock.acquire()
+        self.running = False
+        self.lock.notify()
+        self.lock.release()
+        self.write()
+
+    def run(self):
+        self.lock.acquire()
+        while self.running:
+            if self.dirty:
+                self.lock.release()
+                self.write()
+                self.lock.acquire()
+            else:
+                self.lock.wait()
+        self.lock.release()
+
+    def getKey(self, role, address, id):
+        return "%s %s %s" % (role, address, id)
+
+    def set(self, role, address, id, entry):
+        entry["role"] = role
+        entry["buddy"] = address
+        entry["id"] = id
+        entry["time"] = time.time()
+        self.lock.acquire()
+        self.entries[self.getKey(role, address, id)] = entry
+        self.save()
+        self.lock.release()
+
+    def get(self, role, address, id):
+        return self.entries.get(self.getKey(role, address, id))
+
+    def remove(self, role, address, id):
+        self.lock.acquire()
+        if self.entries.pop(self.getKey(role, address, id), None):
+            self.save()
+        self.lock.release()
+
+    def getEntries(self, role):
+        self.lock.acquire()
+        entries = [entry for entry in self.entries.values() if entry["role"] == role]
+        self.lock.release()
+        return entries
+
+
+class ContentIndex(object):
+    """Remembers where we have files with a known content hash (the sha256
+    of the whole file), the files we have received and saved and the files
+    we have sent. When a sender tells us the content hash of the file it
+    is sending (see ProtocolMsg_filedigest) and we have it already the
+    FileReceiver copies our file instead of receiving it. An entry is
+    only trusted as long as size and modification time of the file are
+    unchanged. The files in the auto save folder are hashed and added
+    when they have the size of a file that is not in the index, but not
+    more than MAX_HASH_FILES files or MAX_HASH_SIZE bytes per search.
+
+    This is off by default and must be switched on with the option
+    reuse_local_files in section [files]: any buddy could find out which
+    files we have by sending us files. Nothing is added to the index
+    while it is off."""
+
+    FILE_NAME = "file-index.json"
+    MAX_ENTRIES = 1000
+    MAX_HASH_FILES = 10
+    MAX_HASH_SIZE = 1073741824
+
+    def __init__(self):
+        self.file_name = os.path.join(config.getDataDir(), self.FILE_NAME)
+        self.lock = threading.RLock()
+        self.entries = {}
+        if os.path.exists(self.file_name):
+            try:
+                f = open(self.file_name, "r")
+                self.entries = json.load(f)
+                f.close()
+            except:
+                tb()
+                print "(1) could not read the file index"
+
+    def save(self):
+        try:
+            saveJsonFile(self.file_name, self.entries)
+        except:
+            tb()
+            print "(1) could not write the file index"
+
+    def isEnabled(self):
+        return config.getint("files", "reuse_local_files")
+
+    def add(self, digest, file_name, save=True):
+        if not self.isEnabled():
+            return
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            return
+        self.lock.acquire()
+        self.entries[digest] = {
+            "path" : config.toUnicode(file_name),
+            "size" : stat.st_size,
+            "mtime" : stat.st_mtime,
+            "time" : time.time()}
+        if len(self.entries) > self.MAX_ENTRIES:
+            oldest = min(self.entries, key=lambda key: self.entries[key]["time"])
+            del self.entries[oldest]
+        if save:
+            self.save()
+        self.lock.release()
+
+    def isValid(self, entry):
+        try:
+            stat = os.stat(entry["path"])
+            return stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]
+        except OSError:
+            return False
+
+    def find(self, digest, size):
+        """return the name of a file with this content or None"""
+        if not self.isEnabled():
+            return None
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(digest)
+            if entry:
+                if self.isValid(entry):
+                    return entry["path"]
+                del self.entries[digest]
+                self.save()
+            known = set(entry["path"] for entry in self.entries.values() if self.isValid(entry))
+        finally:
+            self.lock.release()
+        return self.searchFolder(config.getUserCustomDir(), digest, size, known)
+
+    def searchFolder(self, folder, digest, size, known):
+        if folder == "":
+            return None
+        # the buddy decides how often we do this, so only
+        # a limited amount of files is hashed every time
+        hashed = 0
+        result = None
+        done = False
+        for path, dirs, files in os.walk(folder):
+            for name in files:
+                file_name = os.path.join(path, name)
+                try:
+                    if file_name in known or os.path.getsize(file_name) != size:
+                        continue
+                    found = hashFile(file_name)
+                except (IOError, OSError):
+                    continue
+                self.add(found, file_name, False)
+                hashed += 1
+                if found == digest:
+                    result = file_name
+                    done = True
+                elif hashed >= self.MAX_HASH_FILES or hashed * size >= self.MAX_HASH_SIZE:
+                    print "(2) ContentIndex: giving up the search after %i files" % hashed
+                    done = True
+                if done:
+                    break
+            if done:
+                break
+        if hashed:
+            self.lock.acquire()
+            self.save()
+            self.lock.release()
+        return result
+
+
+class IntervalSet(object):
+    """A set of byte ranges [start, end), kept as two sorted lists of
+    the starts and ends of non overlapping and non adjacent intervals.
+    Used for the blocks of a file transfer that have been received
+    or confirmed, no matter in which order they arrived."""
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self.size = 0
+        for start, end in intervals:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if end <= start:
+            return
+        # all intervals from i to j-1 are overlapping or adjacent
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            self.size -= sum(self.ends[k] - self.starts[k] for k in range(i, j))
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.size += end - start
+
+    def contains(self, start, end):
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def getMissing(self, start, end):
+        """return a list of (start, end) of all gaps in the given range"""
+        missing = []
+        pos = start
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while pos < end and i < len(self.starts):
+            if self.starts[i] > pos:
+                missing.append((pos, min(self.starts[i], end)))
+            pos = max(pos, self.ends[i])
+            i += 1
+        if pos < end:
+            missing.append((pos, end))
+        return missing
+
+    def getEnd(self, pos):
+        """return the end of the interval that contains pos
+        or pos itself if it is not in the set"""
+        i = bisect.bisect_right(self.starts, pos) - 1
+        if i >= 0 and self.ends[i] > pos:
+            return self.ends[i]
+        return pos
+
+    def getSize(self):
+        return self.size
+
+    def getIntervals(self):
+        return zip(self.starts, self.ends)
+
+
+class SendWindow(object):
+    """Decides how many bytes a FileSender may have in flight (sent but
+    not yet confirmed with filedata_ok). The window starts at the fixed
+    16 blocks of 8KB that the old FileSender always used (or 2 blocks if
+    they are larger), this is also the floor, it will never get smaller
+    than that. It grows with every
+    confirmed block (exponentially until the first sign of congestion,
+    then by one block per round trip) and shrinks when the round trip
+    time rises far above the smallest one we have seen (the data is
+    piling up in some buffer on the way instead of moving faster) or
+    when blocks have been lost (missing blocks, disconnect, timeout).
+
+    The round trip time is measured from sending a filedata until its
+    filedata_ok arrives. Blocks that have been sent more than once are
+    not measured because we could not know which one was confirmed"""
+    FLOOR = 16 * 8192
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.floor = max(self.FLOOR, 2 * block_size)
+        self.ceiling = max(self.floor, config.getint("files", "send_window_max"))
+        self.size = self.floor
+        self.ssthresh = self.ceiling
+        self.srtt = 0.0
+        self.min_rtt = 0.0
+        self.last_decrease = 0
+        self.sent = {} # start -> time of sending or None if sent again
+        self.lost = set() # blocks that are not in flight anymore but not confirmed
+        self.lock = threading.Lock()
+
+    def onSend(self, start):
+        self.lock.acquire()
+        if start in self.sent or start in self.lost:
+            self.lost.discard(start)
+            self.sent[start] = None
+        else:
+            self.sent[start] = time.time()
+        self.lock.release()
+
+    def onAck(self, start):
+        self.lock.acquire()
+        try:
+            self.lost.discard(start)
+            self.update(self.sent.pop(start, None))
+        finally:
+            self.lock.release()
+
+    def update(self, sent):
+        if not sent:
+            return
+        now = time.time()
+        rtt = now - sent
+        if self.srtt:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.min_rtt = min(self.min_rtt, rtt)
+        else:
+            self.srtt = self.min_rtt = rtt
+
+        if self.srtt > 2 * self.min_rtt + 0.05:
+            # queueing delay is growing, but only
+            # decrease once per round trip
+            if now - self.last_decrease > self.srtt:
+                self.last_decrease = now
+                self.ssthresh = max(self.floor, int(self.size * 0.75))
+                self.size = self.ssthresh
+        elif self.size < self.ssthresh:
+            self.size += self.block_size
+        else:
+            self.size += self.block_size * self.block_size / self.size
+
+        self.size = min(self.size, self.ceiling)
+
+    def onLoss(self, starts):
+        """the blocks in starts are not in flight anymore,
+        they will be sent again later"""
+        self.lock.acquire()
+        for start in starts:
+            if start in self.sent:
+                del self.sent[start]
+            self.lost.add(start)
+        # many blocks are usually lost at once, only
+        # decrease once per round trip
+        now = time.time()
+        if now - self.last_decrease > self.srtt:
+            self.ssthresh = max(self.floor, self.size / 2)
+            self.size = self.ssthresh
+            self.last_decrease = now
+        self.lock.release()
+
+    def getInFlight(self):
+        return len(self.sent) * self.block_size
+
+    def getInFlightBlocks(self):
+        self.lock.acquire()
+        blocks = self.sent.keys()
+        self.lock.release()
+        return blocks
+
+    def getStats(self):
+        return {"window" : self.size, "rtt" : self.srtt}
+
+
+class TokenBucket(object):
+    """Allows rate bytes per second on average with bursts of up to one
+    second worth of data. The tokens can go negative (a block is always
+    taken as a whole, even if it is larger than the burst), then nothing
+    more is allowed until the debt is paid. A rate of 0 means unlimited"""
+    def __init__(self):
+        self.rate = 0
+        self.tokens = 0.0
+        self.last = time.time()
+
+    def setRate(self, rate):
+        if rate != self.rate:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def getDelay(self, now):
+        """return the seconds until data may be sent again"""
+        if self.rate:
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if not self.rate or self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def take(self, size):
+        if self.rate:
+            self.tokens -= size
+
+
+class TransferScheduler(threading.Thread):
+    """Decides which FileSender may send its next block. Every FileSender
+    asks with waitTurn() before it sends a block and this thread grants
+    the turns one after the other: first the buddies share the upload
+    equally, then the transfers to the same buddy share equally what
+    their buddy gets. This is start time fair queuing, each buddy and
+    each transfer has a virtual time that advances by the size of every
+    granted block, the one that is furthest behind is next.
+
+    The total upload and the upload to every single buddy can be limited
+    with the options upload_limit and upload_limit_buddy in section
+    [files] (KB/s, 0 means no limit)"""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock = threading.Condition()
+        self.running = True
+        self.senders = {} # FileSender -> its state
+        self.buddies = {} # address -> state of all its transfers
+        self.bucket = TokenBucket()
+        self.vtime = 0.0
+        self.start()
+
+    def add(self, sender):
+        self.lock.acquire()
+        address = sender.buddy.address
+        if address not in self.buddies:
+            self.buddies[address] = {
+                "pass" : self.vtime,
+                "vtime" : 0.0,
+                "bucket" : TokenBucket()}
+        self.senders[sender] = {
+            "pass" : self.buddies[address]["vtime"],
+            "request" : None}
+        self.lock.release()
+
+    def remove(self, sender):
+        self.lock.acquire()
+        state = self.senders.pop(sender, None)
+        if state:
+            if state["request"]:
+                # let it return from waitTurn()
+                state["request"][1].set()
+            address = sender.buddy.address
+            if not [s for s in self.senders if s.buddy.address == address]:
+                del self.buddies[address]
+        self.lock.release()
+
+    def waitTurn(self, sender, size):
+        """block until the sender may send size bytes. Returns False
+        if the sender has been removed while it was waiting. Senders
+        that are not added (anymore) are not scheduled at all"""
+        self.lock.acquire()
+        state = self.senders.get(sender)
+        if not state:
+            self.lock.release()
+            return True
+        event = threading.Event()
+        state["request"] = (size, event)
+        self.lock.notify()
+        self.lock.release()
+        event.wait()
+        return sender in self.senders
+
+    def stop(self):
+        self.lock.acquire()
+        self.running = False
+        for sender, state in self.senders.items():
+            if state["request"]:
+                state["request"][1].set()
+        self.senders = {}
+        self.buddies = {}
+        self.lock.notify()
+        self.lock.release()
+
+    def run(self):
+        self.lock.acquire()
+        while self.running:
+            self.bucket.setRate(config.getint("files", "upload_limit") * 1024)
+            buddy_rate = config.getint("files", "upload_limit_buddy") * 1024
+            for buddy in self.buddies.values():
+                buddy["bucket"].setRate(buddy_rate)
+            delay = self.grantNext(time.time())
+            if delay is None:
+                self.lock.wait()
+            elif delay > 0:
+                self.lock.wait(delay)
+        self.lock.release()
+
+    def grantNext(self, now):
+        """grant the next turn. Returns 0 if a turn was granted, the
+        seconds to wait if all waiting transfers are over their limit
+        or None if nobody is waiting"""
+        waiting = {}
+        for sender, state in self.senders.iteritems():
+            if state["request"]:
+                waiting.setdefault(sender.buddy.address, []).append(sender)
+        if not waiting:
+            return None
+
+        delay = self.bucket.getDelay(now)
+        if delay:
+            return delay
+
+        best = None
+        for address in waiting:
+            buddy = self.buddies[address]
+            buddy_delay = buddy["bucket"].getDelay(now)
+            if buddy_delay:
+                if delay == 0 or buddy_delay < delay:
+                    delay = buddy_delay
+            elif best is None or buddy["pass"] < self.buddies[best]["pass"]:
+                best = address
+        if best is None:
+            return delay
+
+        buddy = self.buddies[best]
+        sender = min(waiting[best], key=lambda s: self.senders[s]["pass"])
+        state = self.senders[sender]
+        size, event = state["request"]
+        state["request"] = None
+
+        # start time fair queuing. A buddy or transfer that was idle
+        # for a while starts at the current virtual time, it cannot
+        # use its idle time for a long burst now.
+        start = max(buddy["pass"], self.vtime)
+        self.vtime = start
+        buddy["pass"] = start + size
+        start = max(state["pass"], buddy["vtime"])
+        buddy["vtime"] = start
+        state["pass"] = start + size
+
+        self.bucket.take(size)
+        buddy["bucket"].take(size)
+        event.set()
+        return 0
+
+    def getStats(self, sender):
+        """stats about the scheduling of one transfer for its GUI"""
+        self.lock.acquire()
+        address = sender.buddy.address
+        limits = [rate for rate in [self.bucket.rate, config.getint("files", "upload_limit_buddy") * 1024] if rate]
+        stats = {
+            "transfers" : len(self.senders),
+            "buddy_transfers" : len([s for s in self.senders if s.buddy.address == address]),
+            "upload_limit" : min(limits or [0])}
+        self.lock.release()
+        return stats
+
+
+class FileHasher(threading.Thread):
+    """Reads a file that is being sent once in the background and computes
+    the md5 of every block (the checksums of the filedata messages) and
+    the digest of the whole file, the sha256 over the md5s of all blocks
+    (see ProtocolMsg_filedigest). The FileSender takes the md5s from here
+    instead of computing them again for every block it sends or resends.
+    In the same pass the content hash for the ContentIndex is computed,
+    the sha256 of the file itself"""
+
+    def __init__(self, file_name, block_size, callback):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.file_name = file_name
+        self.block_size = block_size
+        self.callback = callback
+        self.hashes = [] # binary md5 of the blocks, in file order
+        self.digest = None # hex digest of the whole file
+        self.content_digest = None # hex sha256 of the file
+        self.done = False
+        self.running = True
+        self.start()
+
+    def getHash(self, index):
+        """the md5 (hex) of the block or None if not computed yet"""
+        try:
+            return self.hashes[index].encode("hex")
+        except IndexError:
+            return None
+
+    def run(self):
+        try:
+            file_handle = open(self.file_name, "rb")
+            whole = hashlib.sha256()
+            content = hashlib.sha256()
+            while self.running:
+                data = file_handle.read(self.block_size)
+                if data == "" and self.hashes:
+                    break
+                #(an empty file still has its one empty block)
+                hash = hashlib.md5(data).digest()
+                whole.update(hash)
+                content.update(data)
+                self.hashes.append(hash)
+                if len(data) < self.block_size:
+                    break
+            file_handle.close()
+            if self.running:
+                self.digest = whole.hexdigest()
+                self.content_digest = content.hexdigest()
+                print "(2) FileHasher: %i blocks of %s hashed" % (len(self.hashes), self.file_name)
+        except:
+            tb()
+        self.done = True
+        self.callback(self)
+
+
+class DiskWriter(threading.Thread):
+    """Writes the received file data to the disk for all FileReceivers so
+    the network threads don't have to wait for the disk. The blocks are
+    buffered in memory, contiguous blocks of the same file are joined and
+    written with one large write as soon as enough has come together or
+    after a short delay. A FileReceiver confirms a block as soon as it is
+    buffered here. This thread also makes the checkpoints (fsync and the
+    journal, see FileReceiver.checkpoint()) every checkpoint_interval
+    seconds (section [files]), so the journal only ever contains what is
+    safely on the disk.
+
+    If the disk can't keep up write() blocks when too much is buffered,
+    this will slow down the senders through their send windows. The
+    Reactor must never wait, it asks isFull() instead and stops reading
+    from the connection until callWhenDrained() tells it to go on"""
+
+    WRITE_SIZE = 1048576 # write as soon as this much is contiguous
+    DELAY = 0.5 # seconds data may stay in memory before it is written
+    MAX_BUFFERED = 16777216 # write() blocks when this much is buffered
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock = threading.Condition()
+        self.running = True
+        self.pending = {} # FileReceiver -> list of [start, bytearray]
+        self.since = {} # FileReceiver -> time of its oldest buffered data
+        self.dirty = {} # FileReceiver -> time of its next checkpoint
+        self.buffered = 0
+        self.drained = [] # functions waiting for callWhenDrained()
+        self.start()
+
+    def isFull(self):
+        return self.buffered > self.MAX_BUFFERED
+
+    def callWhenDrained(self, function):
+        """call function() as soon as the buffer is not full anymore
+        (from the DiskWriter thread) or immediately if it isn't"""
+        self.lock.acquire()
+        if self.isFull() and self.running:
+            self.drained.append(function)
+            function = None
+        self.lock.release()
+        if function:
+            function()
+
+    def takeDrained(self):
+        """(must hold the lock) return the functions that are waiting
+        for callWhenDrained() if the buffer is not full anymore"""
+        if self.isFull() and self.running:
+            return []
+        drained = self.drained
+        self.drained = []
+        return drained
+
+    def write(self, receiver, start, data):
+        self.lock.acquire()
+        if not isinstance(threading.currentThread(), Reactor):
+            while self.isFull() and self.running:
+                self.lock.wait()
+        runs = self.pending.setdefault(receiver, [])
+        if runs and runs[-1][0] + len(runs[-1][1]) == start \
+        and len(runs[-1][1]) < self.WRITE_SIZE:
+            runs[-1][1] += data
+            if len(runs[-1][1]) >= self.WRITE_SIZE:
+                self.lock.notifyAll()
+        else:
+            runs.append([start, bytearray(data)])
+            if receiver not in self.since:
+                self.since[receiver] = time.time()
+            self.lock.notifyAll()
+        self.buffered += len(data)
+        self.lock.release()
+
+    def flush(self, receiver):
+        """write everything that is buffered for the receiver. This
+        is also called by the receiver before it closes its file"""
+        receiver.lock.acquire()
+        try:
+            self.lock.acquire()
+            runs = self.pending.pop(receiver, [])
+            self.since.pop(receiver, None)
+            self.lock.release()
+            size = 0
+            error = None
+            for start, data in runs:
+                size += len(data)
+                if receiver.closed or receiver.discarded or error:
+                    continue
+                try:
+                    receiver.file_handle_tmp.seek(start)
+                    receiver.file_handle_tmp.write(data)
+                    receiver.written.add(start, start + len(data))
+                except:
+                    tb()
+                    error = str(sys.exc_info()[1])
+            self.lock.acquire()
+            self.buffered -= size
+            if runs and not receiver.closed and receiver not in self.dirty:
+                interval = config.getint("files", "checkpoint_interval")
+                self.dirty[receiver] = receiver.last_checkpoint + interval
+            self.lock.notifyAll()
+            drained = self.takeDrained()
+            self.lock.release()
+        finally:
+            receiver.lock.release()
+        for function in drained:
+            function()
+        if error:
+            receiver.onWriteError(error)
+
+    def checkpointSoon(self, receiver):
+        """make the receiver's next checkpoint now (in our thread)"""
+        self.lock.acquire()
+        self.dirty[receiver] = 0
+        self.lock.notifyAll()
+        self.lock.release()
+
+    def cancel(self, receiver):
+        """the receiver's data is not needed anymore, forget what is
+        buffered for it without writing it (after waiting for a
+        write that might just be going on)"""
+        receiver.lock.acquire()
+        self.lock.acquire()
+        runs = self.pending.pop(receiver, [])
+        self.since.pop(receiver, None)
+        self.dirty.pop(receiver, None)
+        for start, data in runs:
+            self.buffered -= len(data)
+        self.lock.notifyAll()
+        drained = self.takeDrained()
+        self.lock.release()
+        receiver.lock.release()
+        for function in drained:
+            function()
+
+    def remove(self, receiver):
+        """the receiver is closed, forget it"""
+        self.flush(receiver)
+        self.lock.acquire()
+        self.dirty.pop(receiver, None)
+        self.lock.release()
+
+    def stop(self):
+        """write everything that is still buffered and make the
+        checkpoints, so all the transfers can be resumed"""
+        self.lock.acquire()
+        self.running = False
+        self.lock.notifyAll()
+        receivers = self.pending.keys() + self.dirty.keys()
+        self.dirty = {}
+        drained = self.takeDrained()
+        self.lock.release()
+        for function in drained:
+            function()
+        for receiver in receivers:
+            self.flush(receiver)
+            receiver.checkpoint()
+
+    def run(self):
+        self.lock.acquire()
+        while self.running:
+            now = time.time()
+            wait = None
+            receiver = None
+            for candidate, runs in self.pending.iteritems():
+                deadline = self.since[candidate] + self.DELAY
+                if deadline <= now or len(runs) > 1 or len(runs[0][1]) >= self.WRITE_SIZE:
+                    receiver = candidate
+                    break
+                if wait is None or deadline - now < wait:
+                    wait = deadline - now
+            if receiver:
+                self.lock.release()
+                self.flush(receiver)
+                self.lock.acquire()
+                continue
+
+            for candidate, deadline in self.dirty.items():
+                if deadline <= now:
+                    del self.dirty[candidate]
+                    self.lock.release()
+                    candidate.checkpoint()
+                    self.lock.acquire()
+                elif wait is None or deadline - now < wait:
+                    wait = deadline - now
+
+            if self.running:
+                self.lock.wait(wait)
+        self.lock.release()
+
+
+class MappedFile(object):
+    """Reads the blocks of a file that is being sent by slicing them out
+    of a memory mapping instead of seek() and read() for every block.
+    Only a window of the file is mapped at a time, so this also works
+    for files that are larger than the memory (or the address space of
+    a 32 bit process), the window is moved when a block is outside of
+    it. If the file cannot be mapped it is read the normal way"""
+
+    WINDOW = 16777216
+
+    def __init__(self, file_handle):
+        self.file_handle = file_handle
+        self.fileno = file_handle.fileno()
+        self.map = None
+        self.map_start = 0
+        self.map_end = 0
+        self.failed = False
+
+    def read(self, start, length):
+        #reading a mapping beyond the end of the file would kill us
+        #with SIGBUS, the file might have been shortened meanwhile
+        size = os.fstat(self.fileno).st_size
+        end = min(start + length, size)
+        if start >= end:
+            return ""
+        if (start < self.map_start or end > self.map_end) and not self.failed:
+            self.remap(start, size)
+        if self.map is None:
+            self.file_handle.seek(start)
+            return self.file_handle.read(end - start)
+        return self.map[start - self.map_start:end - self.map_start]
+
+    def remap(self, start, size):
+        self.close()
+        offset = start - start % mmap.ALLOCATIONGRANULARITY
+        length = min(self.WINDOW, size - offset)
+        try:
+            self.map = mmap.mmap(self.fileno, length, access=mmap.ACCESS_READ, offset=offset)
+            self.map_start = offset
+            self.map_end = offset + length
+        except (EnvironmentError, ValueError), e:
+            print "(2) MappedFile: cannot map file, reading it normally (%s)" % e
+            self.failed = True
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.map_start = self.map_end = 0
+
+
+class BlockCompressor(object):
+    """Compresses the blocks of a file that is being sent to a client that
+    can decompress them (see ProtocolMsg_filedata_z) with the zlib level
+    of the option compression_level in section [files] (0 is off). Blocks
+    that don't get smaller are sent as they are. After such a block only
+    a small sample of the next block is tried with the fastest level and
+    the block is only compressed if the sample got smaller, so files
+    that are compressed already (archives, jpegs, videos) cost almost no
+    CPU time but a file that is only partly compressible (an archive
+    with some text files that are only stored) is still noticed"""
+
+    # the compressed block must be at least this much smaller
+    # than the original or it is not worth the decompression
+    MIN_SAVING = 0.05
+    SAMPLE = 4096
+
+    def __init__(self):
+        self.level = max(0, min(config.getint("files", "compression_level"), 9))
+        self.failed = False # the last block did not get smaller
+        self.raw = 0 # total bytes of all blocks
+        self.wire = 0 # total bytes of all blocks as they were sent
+
+    def isWorthIt(self, data, compressed_size):
+        return compressed_size <= len(data) * (1 - self.MIN_SAVING)
+
+    def compress(self, data):
+        """return the compressed data or None if it isn't worth it"""
+        compressed = None
+        if self.level:
+            if self.failed and len(data) > 2 * self.SAMPLE:
+                middle = len(data) // 2
+                sample = data[middle:middle + self.SAMPLE]
+                try_it = self.isWorthIt(sample, len(zlib.compress(sample, 1)))
+            else:
+                try_it = True
+            if try_it:
+                result = zlib.compress(data, self.level)
+                self.failed = not self.isWorthIt(data, len(result))
+                if not self.failed:
+                    compressed = result
+        self.raw += len(data)
+        self.wire += len(compressed or data)
+        return compressed
+
+    def getRatio(self):
+        """bytes sent per byte of the file"""
+        if not self.raw:
+            return 1.0
+        return float(self.wire) / self.raw
+
+
+class ProgressReporter(object):
+    """Stands between a FileSender or FileReceiver and the callback of
+    its GUI. They report the progress after every block but the GUI
+    does not need to redraw more than a few times per second, so plain
+    progress (no error_msg and not complete) is passed on at most every
+    INTERVAL seconds, the last report that has been held back follows
+    with a timer of the TimerWheel. Everything else (errors, the status
+    texts and the completion) is passed on immediately. After the end
+    (complete or error) plain progress is dropped.
+
+    The reports are passed on while holding the lock, so they arrive
+    in order even if they come from different threads. The callback
+    must therefore not wait for another thread that reports progress.
+
+    The transfer rate in bytes per second and the estimated seconds
+    until the transfer is complete (None while there is no rate) are
+    calculated over the last WINDOW seconds, they are added to the
+    stats as "rate" and "eta"."""
+
+    INTERVAL = 0.1
+    WINDOW = 5
+
+    def __init__(self, bl, callback):
+        self.bl = bl
+        self.callback = callback
+        self.lock = threading.RLock()
+        self.last = 0 # time of the last report that was passed on
+        self.finished = False # complete or error has been passed on
+        self.pending = None # the report that has been held back
+        self.timer = None
+        self.samples = [] # (time, complete) of the reports passed on
+
+    def __call__(self, total, complete, error_msg="", stats=None):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if not error_msg and 0 <= complete < total and self.finished:
+                # a late one from another thread
+                return
+            if not error_msg and 0 <= complete < total \
+            and now - self.last < self.INTERVAL:
+                self.pending = (total, complete, error_msg, stats)
+                if not self.timer:
+                    self.timer = self.bl.timer_wheel.callLater(self.INTERVAL, self.onTimer)
+                return
+            self.pending = None
+            if complete < 0 or complete >= total:
+                self.finished = True
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+            self.callback(*self.prepare(now, total, complete, error_msg, stats))
+        finally:
+            self.lock.release()
+
+    def onTimer(self):
+        self.lock.acquire()
+        try:
+            self.timer = None
+            pending, self.pending = self.pending, None
+            if pending and not self.finished:
+                self.callback(*self.prepare(time.time(), *pending))
+        finally:
+            self.lock.release()
+
+    def prepare(self, now, total, complete, error_msg, stats):
+        self.last = now
+        stats = dict(stats or {})
+        if complete >= 0:
+            samples = self.samples
+            if samples and complete < samples[-1][1]:
+                # it has started again from the beginning
+                del samples[:]
+            samples.append((now, complete))
+            # keep the newest sample that is older than the window
+            while len(samples) > 2 and now - samples[1][0] >= self.WINDOW:
+                del samples[0]
+            start, start_complete = samples[0]
+            if now > start:
+                stats["rate"] = (complete - start_complete) / (now - start)
+            else:
+                stats["rate"] = 0
+            if stats["rate"] > 0:
+                stats["eta"] = (total - complete) / stats["rate"]
+            else:
+                stats["eta"] = None
+        return total, complete, error_msg, stats
+
+
 class FileSender(threading.Thread):
-    def __init__(self, buddy, file_name, callback):
+    """Sends one file to a buddy. This is a little state machine on its
+    own thread, it does not poll. The thread sleeps until one of the
+    events wakes it up: receivedOK(), resendRange(), close() or a change
+    of the connection to the buddy (see Buddy.notifyFileSenders()), or
+    until the time for the outstanding confirmations has run out.
+
+    The blocks can be confirmed in any order. Blocks that are reported
+    missing, or that were in flight when the connection went down or
+    when the timeout occurred, are sent again before any new block, but
+    only those that have not been confirmed yet.
+
+    When the connection comes back or when we are resumed from the
+    TransferJournal after a restart the filename message is sent again
+    (to clients that know CAP_RESUME) and the receiver answers with a
+    filedata_received that tells us which blocks it already has.
+
+    The block hashes and the digest of the whole file come from a
+    FileHasher. The digest is sent before the last block (and again after
+    every repeated filename) so the receiver can verify the whole file.
+    The blocks are read through a MappedFile and compressed by a
+    BlockCompressor if the receiver knows filedata_z."""
+
+    # seconds without any filedata_ok (while we are connected)
+    # until we assume that the blocks in flight are lost
+    TIMEOUT = 200
+
+    # the block size every client understands
+    LEGACY_BLOCK_SIZE = 8192
+    MAX_BLOCK_SIZE = 1048576
+
+    # seconds to wait for the client and version messages of the buddy
+    # after the connection is established, they decide the block size
+    VERSION_WAIT = 5
+
+    # seconds to wait for the filedata_received after
+    # sending the filename again before we just go on
+    RESUME_WAIT = 30
+
+    def __init__(self, buddy, file_name, callback, resume=None):
         threading.Thread.__init__(self)
         self.buddy = buddy
         self.bl = buddy.bl
         self.file_name = file_name
         self.file_name_short = os.path.basename(self.file_name)
-        self.gui = callback
-        self.id = str(random.getrandbits(32))
+        if callback:
+            self.gui = ProgressReporter(self.bl, callback)
+        else:
+            #resumed from the journal, the GUI will give us
+            #its callback when its window is ready
+            self.gui = self.noGui
+        self.resumed = resume is not None
+        if self.resumed:
+            self.id = resume["id"]
+            self.block_size = resume["block_size"]
+        else:
+            self.id = str(random.getrandbits(32))
+            self.block_size = self.LEGACY_BLOCK_SIZE
         self.buddy.bl.file_sender[self.buddy.address, self.id] = self
         self.file_size = 0
-        self.block_size = 8192
-        self.blocks_wait = 16
-        self.start_ok = -1
-        self.restart_at = 0
-        self.restart_flag = False
+        self.window = SendWindow(self.block_size)
+        self.acked = IntervalSet()
+        self.resend = [] # sorted list of block starts to send again
+        self.position = 0 # start of the next new block to send
         self.completed = False
-        self.timeout_count = 0
+        self.running = True
+        self.last_activity = time.time()
+        self.reannounce = False # send the filename again when connected
+        self.connection = None # the conn_in we are sending over
+        self.expect_state = False # waiting for filedata_received
+        self.state_deadline = 0
+        self.hasher = None
+        self.digest_sent = False
+        self.rehash = set() # blocks the receiver had a wrong hash for
+        self.compressor = BlockCompressor()
+        self.wakeup = threading.Condition()
         self.start()
 
+    def setCallbackFunction(self, callback):
+        self.gui = ProgressReporter(self.bl, callback)
 
-    def testTimeout(self):
-        #this will be called every 0.1 seconds whenever the sender
-        #is waiting for confirmation messages. Either in the
-        #sendBlocks() loop or when all blocks are sent in the
-        #outer loop in run()
-        #if a timeout is detected then the restart flag will be set
-        if self.buddy.isFullyConnected():
-            #we only increase timeout if we are connected
-            #otherwise other mechanisms are responsible and trying
-            #to get us connected again and we just wait
-            self.timeout_count += 1
-        else:
-            self.timeout_count = 0
-
-        if self.timeout_count == 2000:
-            #ten minutes without filedata_ok
-            new_start = self.start_ok + self.block_size
-            self.restart(new_start)
-            #enforce a new connection
-            try:
-                if config.getint("files", "reconnect_on_timeout"):
-                    self.buddy.disconnect()
-            except:
-                pass
-            print "(2) timeout file sender restart at %i" % new_start
+    def noGui(self, *args):
+        pass
 
-    def canGoOn(self, start):
-        position_ok = self.start_ok + self.blocks_wait * self.block_size
-        if not self.running or self.restart_flag:
-            return True
-        else:
-            return  position_ok > start
-
-
-    def sendBlocks(self, first):
-        blocks = int(self.file_size / self.block_size) + 1
-
-        print "(2) FileSender now entering inner loop, starting at block #%i, last block in file #%i" \
-              % (first, blocks - 1)
-        #the inner loop (of the two loops
-        for i in range(blocks):
-            start = i * self.block_size
-            #jump over already sent blocks
-            if start >= first:
-                remaining = self.file_size - start
-                if remaining > self.block_size:
-                    size = self.block_size
+    def wake(self):
+        self.wakeup.acquire()
+        self.wakeup.notify()
+        self.wakeup.release()
+
+    def onConnectionChanged(self):
+        self.wake()
+
+    def waitForConnection(self):
+        self.wakeup.acquire()
+        while self.running and not self.buddy.isFullyConnected():
+            self.wakeup.wait()
+        self.wakeup.release()
+
+    def waitForVersion(self):
+        timeout = time.time() + self.VERSION_WAIT
+        self.wakeup.acquire()
+        while self.running and self.buddy.version == "":
+            remaining = timeout - time.time()
+            if remaining <= 0:
+                break
+            self.wakeup.wait(remaining)
+        self.wakeup.release()
+
+    def chooseBlockSize(self):
+        """the buddy will accept any block size we announce in the
+        filename message but old clients cannot cope with long lines,
+        only clients that we know can do it will get large blocks"""
+        if not self.buddy.hasCapability(CAP_LARGE_BLOCKS):
+            return self.LEGACY_BLOCK_SIZE
+        size = config.getint("files", "block_size_max")
+        return max(self.LEGACY_BLOCK_SIZE, min(size, self.MAX_BLOCK_SIZE))
+
+    def nextBlock(self):
+        """wait until the window allows sending the next block and
+        return its start position, or None if the transfer has ended"""
+        self.wakeup.acquire()
+        try:
+            while self.running and not self.completed:
+                now = time.time()
+                if not self.buddy.isFullyConnected():
+                    #everything in flight went down with the connection.
+                    #the timeout only counts while we are connected,
+                    #otherwise other mechanisms are responsible and
+                    #trying to get us connected again and we just wait
+                    if self.window.getInFlight():
+                        self.resendRange(0, self.position)
+                    self.reannounce = True
+                    self.digest_sent = False
+                    self.last_activity = now
+                    self.wakeup.wait()
+                    continue
+
+                if self.buddy.conn_in is not self.connection:
+                    #a new connection. It might have come back before
+                    #we even noticed that the old one was gone.
+                    self.connection = self.buddy.conn_in
+                    if self.window.getInFlight():
+                        self.resendRange(0, self.position)
+                    self.reannounce = True
+                    self.digest_sent = False
+
+                if self.reannounce:
+                    self.reannounce = False
+                    if self.buddy.hasCapability(CAP_RESUME):
+                        #the receiver might have missed the filename
+                        #or was restarted, ask it what it has.
+                        self.wakeup.release()
+                        try:
+                            self.announce(True)
+                        finally:
+                            self.wakeup.acquire()
+                        continue
+
+                if self.state_deadline:
+                    remaining = self.state_deadline - now
+                    if remaining > 0:
+                        self.wakeup.wait(remaining)
+                        continue
+                    print "(2) FileSender got no filedata_received, going on"
+                    self.expect_state = False
+                    self.state_deadline = 0
+
+                if self.hasher.done and not self.digest_sent:
+                    self.digest_sent = True
+                    if self.hasher.digest and self.buddy.hasCapability(CAP_FILE_DIGEST):
+                        self.wakeup.release()
+                        try:
+                            self.sendDigest()
+                        finally:
+                            self.wakeup.acquire()
+                        continue
+
+                if self.window.getInFlight() + self.block_size <= self.window.size:
+                    if self.resend:
+                        return self.resend.pop(0)
+                    end = self.acked.getEnd(self.position)
+                    if end > self.position:
+                        #the receiver already has these blocks
+                        if end < self.file_size:
+                            end -= end % self.block_size
+                        self.position = end
+                    #an empty file is still sent as one empty block
+                    if self.position < self.file_size or self.position == 0:
+                        if self.position + self.block_size >= self.file_size \
+                        and not self.digest_sent and self.buddy.hasCapability(CAP_FILE_DIGEST):
+                            #the digest must be there before the last block,
+                            #sleep until the FileHasher has finished
+                            self.wakeup.wait()
+                            continue
+                        start = self.position
+                        self.position += self.block_size
+                        return start
+
+                #the window is full (or all blocks are sent), sleep
+                #until something happens or the timeout is reached
+                remaining = self.last_activity + self.TIMEOUT - now
+                if remaining > 0:
+                    self.wakeup.wait(remaining)
                 else:
-                    size = remaining
-                self.file_handle.seek(start)
-                data = self.file_handle.read(size)
-                hash = hashlib.md5(data).hexdigest()
-
-                #we can only send data if we are connected
-                while not self.buddy.isFullyConnected() and not self.restart_flag:
-                    time.sleep(0.1)
-                    self.testTimeout()
-                
-                # the message is sent over conn_in
-                msg = ProtocolMsg_filedata(self.buddy.conn_in, (self.id, start, hash, data))
-                msg.send()
-
-                #wait for confirmations more than blocks_wait behind
-                while not self.canGoOn(start):
-                    time.sleep(0.1)
-                    self.testTimeout() #this can trigger the restart flag
-
-                if self.restart_flag:
-                    #the outer loop in run() will start us again
-                    print "(2) FileSender restart_flag, breaking innner loop"
-                    break
+                    #onTimeout() might disconnect and wake up the other
+                    #senders of this buddy, don't hold our lock meanwhile
+                    self.wakeup.release()
+                    try:
+                        self.onTimeout()
+                    finally:
+                        self.wakeup.acquire()
+            return None
+        finally:
+            self.wakeup.release()
+
+    def onTimeout(self):
+        #no filedata_ok for a long time while we were connected.
+        #everything that is not yet confirmed must be sent again
+        print "(2) timeout file sender, sending unconfirmed blocks again"
+        self.resendRange(0, self.position)
+        #enforce a new connection
+        try:
+            if config.getint("files", "reconnect_on_timeout"):
+                self.buddy.disconnect()
+        except:
+            pass
 
-                if not self.running:
-                    #the outer loop in run() will also end
-                    print "(2) FileSender not running, breaking innner loop"
-                    break
+    def announce(self, expect_state):
+        """send the filename message, the first one or again
+        when resuming, then the receiver's answer is awaited"""
+        if expect_state:
+            self.wakeup.acquire()
+            self.expect_state = True
+            self.state_deadline = time.time() + self.RESUME_WAIT
+            self.wakeup.release()
+        filename_utf8 = self.file_name_short.encode("utf-8")
+        self.connection = self.buddy.conn_in
+        msg = ProtocolMsg_filename(self.connection, (self.id, self.file_size, self.block_size, filename_utf8))
+        msg.send()
+        if self.buddy.hasCapability(CAP_RESUME):
+            self.bl.journal.set("send", self.buddy.address, self.id, {
+                "file_name" : config.toUnicode(self.file_name),
+                "file_size" : self.file_size,
+                "mtime" : int(os.path.getmtime(self.file_name)),
+                "block_size" : self.block_size})
+
+    def onHashed(self, hasher):
+        #(called by the FileHasher when it is done)
+        if hasher.content_digest:
+            self.bl.content_index.add(hasher.content_digest, self.file_name)
+        self.wake()
+
+    def sendDigest(self):
+        msg = ProtocolMsg_filedigest(self.buddy.conn_in,
+            (self.id, self.hasher.digest, self.hasher.content_digest))
+        msg.send()
 
-        print "(2) FileSender inner loop ended, last sent block: #%i, last block in file #%i" % (i, blocks-1)
+    def onReceiverState(self, intervals):
+        """the receiver has told us which parts of the file it already
+        has, everything else must be sent (again), beginning at 0. It
+        can also tell us at any time that it has the complete file (it
+        had it already, see ContentIndex)"""
+        self.wakeup.acquire()
+        if not self.expect_state and IntervalSet(intervals).getSize() < self.file_size:
+            self.wakeup.release()
+            print "(2) FileSender ignoring unexpected filedata_received"
+            return
+        self.expect_state = False
+        self.state_deadline = 0
+        self.acked = IntervalSet(intervals)
+        self.resend = []
+        self.window.onLoss(self.window.getInFlightBlocks())
+        self.position = 0
+        self.last_activity = time.time()
+        complete = self.acked.getSize()
+        if complete == self.file_size:
+            self.completed = True
+        self.wakeup.notify()
+        self.wakeup.release()
+
+        print "(2) FileSender resuming, receiver has %i of %i bytes" % (complete, self.file_size)
+        self.gui(self.file_size, complete, "", self.getStats())
+        if complete == self.file_size:
+            self.gui(self.file_size, complete, "transfer complete")
+
+    def getBlockLength(self, start):
+        return max(0, min(self.block_size, self.file_size - start))
+
+    def getStats(self):
+        stats = self.window.getStats()
+        stats.update(self.bl.transfer_scheduler.getStats(self))
+        stats["compression"] = self.compressor.getRatio()
+        return stats
+
+    def readBlock(self, start):
+        """return the message class, the hash and the data
+        for the block or None if the transfer has been aborted"""
+        data = self.file_map.read(start, self.getBlockLength(start))
+        hash = self.hasher.getHash(start // self.block_size)
+        if hash is None:
+            #the FileHasher has not come this far yet
+            hash = hashlib.md5(data).hexdigest()
+        elif start in self.rehash:
+            self.rehash.discard(start)
+            if hashlib.md5(data).hexdigest() != hash:
+                #the receiver would ask for this block forever
+                print "(1) FileSender: %s has changed during the transfer" % self.file_name
+                self.close()
+                self.gui(self.file_size, -1, "error")
+                return None
+
+        if self.buddy.hasCapability(CAP_COMPRESSION):
+            compressed = self.compressor.compress(data)
+            if compressed is not None:
+                return ProtocolMsg_filedata_z, hash, compressed
+        return ProtocolMsg_filedata, hash, data
+
+    def sendBlock(self, start, Msg, hash, data):
+        # the message is sent over conn_in
+        msg = Msg(self.buddy.conn_in, (self.id, start, hash, data))
+        msg.send()
+        self.window.onSend(start)
 
     def run(self):
-        self.running = True
         try:
             self.file_handle = open(self.file_name, mode="rb")
             self.file_handle.seek(0, 2) #SEEK_END
             self.file_size = self.file_handle.tell()
+            self.file_map = MappedFile(self.file_handle)
             self.gui(self.file_size, 0)
-            filename_utf8 = self.file_name_short.encode("utf-8")
 
             if not self.buddy.isFullyConnected():
                 print "(2) file transfer waiting for connection"
@@ -971,36 +2610,46 @@ class FileSender(threading.Thread):
 
             # self.running will be set to false when the user hits "cancel"
             # wait for connection to start file transfer
-            while self.running and not self.buddy.isFullyConnected():
-                time.sleep(1)
+            self.waitForConnection()
 
-            # user could have aborted while waiting in the loop above
+            # user could have aborted while waiting above
             if self.running:
-                print "(2) sending 'filename' message"
+                if not self.resumed:
+                    self.waitForVersion()
+                    self.block_size = self.chooseBlockSize()
+                    self.window = SendWindow(self.block_size)
+                print "(2) sending 'filename' message, block size %i" % self.block_size
                 self.gui(self.file_size, 0, "starting transfer")
-                msg = ProtocolMsg_filename(self.buddy.conn_in, (self.id, self.file_size, self.block_size, filename_utf8))
-                msg.send()
-
-            #the outer loop (of the two sender loops)
-            #runs forever until completed ore canceled
-            while self.running and not self.completed:
-                print "(2) FileSender now at start of retry loop"
-                self.restart_flag = False
-
-                #(re)start the inner loop
-                self.sendBlocks(self.restart_at)
+                self.hasher = FileHasher(self.file_name, self.block_size, self.onHashed)
+                self.announce(self.resumed)
+                self.bl.transfer_scheduler.add(self)
+
+            #send blocks whenever the window and the scheduler allow
+            #it until the last one is confirmed or the transfer is canceled
+            while True:
+                start = self.nextBlock()
+                if start is None:
+                    break
+                block = self.readBlock(start)
+                if block is None:
+                    continue
+                Msg, hash, data = block
+                if not self.bl.transfer_scheduler.waitTurn(self, len(data)):
+                    continue
+                self.sendBlock(start, Msg, hash, data)
 
-                #wait for *last* filedata_ok or restart flag
-                while self.running and not self.completed and not self.restart_flag:
-                    time.sleep(0.1)
-                    self.testTimeout() #this can trigger the restart flag
+            self.bl.transfer_scheduler.remove(self)
 
             if self.running:
-                print "(2) FileSender, retry loop ended because of success"
+                print "(2) FileSender ended because of success"
+                self.bl.journal.remove("send", self.buddy.address, self.id)
             else:
-                print "(2) FileSender, retry loop ended because of cancel"
+                print "(2) FileSender ended because of cancel"
 
             self.running = False
+            if self.hasher:
+                self.hasher.running = False
+            self.file_map.close()
             self.file_handle.close()
 
         except:
@@ -1012,32 +2661,68 @@ class FileSender(threading.Thread):
             tb()
 
     def receivedOK(self, start):
-        self.timeout_count = 0 # we have received a sign of life
-        end = start + self.block_size
-        if end > self.file_size:
-            end = self.file_size
+        self.window.onAck(start)
+        end = min(start + self.block_size, self.file_size)
+
+        self.wakeup.acquire()
+        self.last_activity = time.time() # we have received a sign of life
+        self.acked.add(start, end)
+        i = bisect.bisect_left(self.resend, start)
+        if i < len(self.resend) and self.resend[i] == start:
+            #the confirmation was only late, no need to send it again
+            del self.resend[i]
+        complete = self.acked.getSize()
+        if complete == self.file_size:
+            #the sender can now stop waiting for timeout
+            self.completed = True
+        self.wakeup.notify()
+        self.wakeup.release()
 
         try:
-            self.gui(self.file_size, end)
+            self.gui(self.file_size, complete, "", self.getStats())
         except:
             #cannot update gui
             tb()
             self.close()
 
-        self.start_ok = start
-
-        if end == self.file_size:
-            #the outer sender loop can now stop waiting for timeout
-            self.gui(self.file_size, end, "transfer complete")
-            self.completed = True
+        if complete == self.file_size:
+            self.gui(self.file_size, complete, "transfer complete")
+
+    def resendRange(self, start, end):
+        """send all blocks between start and end again
+        that have already been sent but not confirmed yet"""
+        self.wakeup.acquire()
+        #(an empty file still has its one empty block)
+        end = min(end, self.position, max(self.file_size, 1))
+        lost = []
+        for gap_start, gap_end in self.acked.getMissing(start, end):
+            gap_start -= gap_start % self.block_size
+            for block in xrange(gap_start, gap_end, self.block_size):
+                i = bisect.bisect_left(self.resend, block)
+                if i == len(self.resend) or self.resend[i] != block:
+                    self.resend.insert(i, block)
+                lost.append(block)
+        if lost:
+            print "(2) FileSender sending %i blocks again, starting at %i" % (len(lost), lost[0])
+            self.window.onLoss(lost)
+        self.last_activity = time.time()
+        self.wakeup.notify()
+        self.wakeup.release()
 
     def restart(self, start):
-        #trigger the reatart flag
-        self.timeout_count = 0
-        self.restart_at = start
-        self.restart_flag = True
-        #the inner loop will now immediately break and
-        #the outer loop will start it again at position restart_at
+        #old receivers drop every block after a missing one and
+        #want everything from start to be sent again
+        self.resendRange(start, self.position)
+
+    def onError(self, start, end=None):
+        """filedata_error, either the block at start had a wrong hash
+        or the blocks from start to end (or to the end) are missing"""
+        #if it was the hash our cached one might be outdated
+        self.rehash.add(start - start % self.block_size)
+        if end is None:
+            self.restart(start)
+        else:
+            self.resendRange(start, end)
 
     def sendStopMessage(self):
         msg = ProtocolMsg_file_stop_receiving(self.buddy, self.id)
@@ -1051,105 +2736,431 @@ class FileSender(threading.Thread):
                 self.gui(self.file_size, -1, "transfer aborted")
             except:
                 pass
-        del self.buddy.bl.file_sender[self.buddy.address, self.id]
+        self.buddy.bl.file_sender.pop((self.buddy.address, self.id), None)
+        self.bl.journal.remove("send", self.buddy.address, self.id)
+        self.bl.transfer_scheduler.remove(self)
+        if self.hasher:
+            self.hasher.running = False
+        self.wake()
+
+
+class LocalCopyThread(threading.Thread):
+    """Looks for the file of a FileReceiver in the ContentIndex and lets
+    the receiver copy it when it is found. This might take a while (files
+    in the auto save folder might have to be hashed) so it is done in
+    its own thread"""
+    def __init__(self, receiver, content_digest):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.receiver = receiver
+        self.content_digest = content_digest
+        self.start()
+
+    def run(self):
+        try:
+            receiver = self.receiver
+            file_name = receiver.buddy.bl.content_index.find(self.content_digest, receiver.file_size)
+            if file_name:
+                receiver.copyLocal(file_name)
+        except:
+            tb()
+
+
+class ParkedBlocksThread(threading.Thread):
+    """Receives the blocks that a FileReceiver has parked while it was
+    waiting for its callback. setCallbackFunction() is called from the
+    GUI thread, it must not do this itself (the DiskWriter might block)"""
+    def __init__(self, receiver):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.receiver = receiver
+        self.start()
+
+    def run(self):
+        try:
+            self.receiver.processParked()
+        except:
+            tb()
 
 
 class FileReceiver(object):
     # ths will be instantiated automatically on an incoming file transfer.
     # it will then notify the GUI which will open a window and give us a callback to interact
-    def __init__(self, buddy, id, block_size, file_size, file_name):
+    # we don't wait for the callback, the blocks that arrive before it
+    # is there are parked (up to MAX_PARKED bytes, more will make us
+    # refuse the file) and processed when it is set
+    # if resume is given (an entry from the TransferJournal) we continue
+    # an interrupted transfer with the temp file and the ranges we already have
+    # when the sender has sent a filedigest the complete file is verified
+    # before it is reported as complete
+    # if the file name for saving is known before the first block arrives
+    # (auto save) we write directly into that file (option write_direct),
+    # otherwise the temp file is moved there when we are closed
+    # the data is written by the DiskWriter of the BuddyList
+    # if the sender tells us the content hash and we have the file already
+    # (ContentIndex) we copy it and tell the sender that we are done
+
+    MAX_PARKED = 8388608
+
+    def __init__(self, buddy, id, block_size, file_size, file_name, resume=None):
         self.buddy = buddy
         self.id = id
         self.closed = False
         self.block_size = block_size
         self.file_name = file_name
         self.file_name_save = ""
-        tmp = createTemporaryFile(self.file_name)
-        self.file_name_tmp, self.file_handle_tmp = tmp
-        print "(2) FileReceiver: created temp file: %s" % self.file_name_tmp
         self.file_size = file_size
+        self.file_digest = None
+        self.content_digest = None
+        self.block_hashes = {} # block index -> md5 of the blocks received
+        self.verified = False
+        self.damaged = False
+        self.discarded = False # given up, nothing must be written anymore
+        self.received_lock = threading.Lock() # see copyLocal()
+        self.direct = False # writing directly into file_name_save
+        # file_handle_tmp can be replaced and is used by the DiskWriter
+        self.lock = threading.RLock()
+        if resume:
+            self.file_name_tmp = resume["tmp"]
+            self.file_handle_tmp = open(self.file_name_tmp, "r+b")
+            self.received = IntervalSet(resume["received"])
+            print "(2) FileReceiver: resuming with temp file: %s" % self.file_name_tmp
+        else:
+            tmp = createTemporaryFile(self.file_name)
+            self.file_name_tmp, self.file_handle_tmp = tmp
+            self.received = IntervalSet()
+            print "(2) FileReceiver: created temp file: %s" % self.file_name_tmp
+        # the received ranges that the DiskWriter has written
+        self.written = IntervalSet(self.received.getIntervals())
+        # end of the furthest block received so far
         self.next_start = 0
-        self.wrong_block_number_count = 0
+        for start, end in self.received.getIntervals():
+            self.next_start = end
+        self.last_checkpoint = 0
         self.buddy.bl.file_receiver[self.buddy.address, self.id] = self
+        # (not here, we are in the network thread and this means fsync)
+        self.buddy.bl.disk_writer.checkpointSoon(self)
 
-        #this will (MUST) point to the file transfer GUI callback
-        self.gui = None
+        #we cannot receive without a GUI (or other piece of code
+        #that provides the callback, see tc_daemon) because this
+        #other code will decide what to do with the file and will
+        #be responsible to close this FileReceiver object again
+        #after it is done. The GUI opens its window later (CallAfter)
+        #but we must not block the connection of this buddy until
+        #then, so until the callback is there the incoming blocks
+        #are parked (a sender should not send more than its window
+        #without our filedata_ok, we refuse the file if it does)
+        #and the last progress is remembered.
+        self.gui = self.noGui
+        self.gui_pending = None
+        self.parked = []
+        self.parked_size = 0
+        self.park_lock = threading.Lock()
 
         #the following will result in a call into the GUI
         #the GUI will then give us a callback function
         print "(2) FileReceiver: notifying GUI about new file transfer"
         self.buddy.bl.gui(CB_TYPE_FILE, self)
 
-        #we cannot receive without a GUI (or other piece of code
-        #that provides the callback) because this other code
-        #(usually the GUI) will decide what to do with the file
-        #and will be responsible to close this FileReceiver object
-        #again after it is done.
-
-        #therefore now we wait for the callback
-        #function to be provided before we continue.
-        #It CANNOT get stuck in this loop unless the GUI
-        #code is broken. The GUI WILL provide this callback!
-        while self.gui == None:
-            time.sleep(0.1)
-
-        print "(2) FileReceiver: attached GUI seems ready, initialization done"
-
     def setCallbackFunction(self, callback):
         # this must be called from the GUI
         # to set the callback function so we can notify
         # the GUI about the progress (or errors)
-        self.gui = callback
+        self.gui = ProgressReporter(self.buddy.bl, callback)
+        if self.gui_pending:
+            self.gui(*self.gui_pending)
+        self.park_lock.acquire()
+        if self.parked:
+            self.park_lock.release()
+            ParkedBlocksThread(self)
+        else:
+            self.parked = None
+            self.park_lock.release()
+
+    def processParked(self):
+        # (in the ParkedBlocksThread) blocks that arrive meanwhile are
+        # parked behind the others until all of them have been received
+        while True:
+            self.park_lock.acquire()
+            parked = self.parked
+            if parked:
+                self.parked = []
+            else:
+                self.parked = None
+            self.parked_size = 0
+            self.park_lock.release()
+            if not parked:
+                break
+            print "(2) FileReceiver: processing %i parked blocks" % len(parked)
+            for start, hash, data in parked:
+                self.receiveData(start, hash, data)
+
+    def noGui(self, *args):
+        self.gui_pending = args
 
     def data(self, start, hash, data):
         if self.closed:
+            return
+        self.park_lock.acquire()
+        if self.parked is not None:
+            if self.parked_size + len(data) > self.MAX_PARKED:
+                self.parked = []
+                self.parked_size = 0
+                self.park_lock.release()
+                print "(1) FileReceiver: too much data for %s while waiting for the GUI, refusing it" % self.file_name
+                self.closeForced()
+                return
+            self.parked.append((start, hash, data))
+            self.parked_size += len(data)
+            self.park_lock.release()
+            return
+        self.park_lock.release()
+        self.receiveData(start, hash, data)
+
+    def receiveData(self, start, hash, data):
+        if self.closed or self.damaged or self.discarded:
             # ignore still incoming data blocks
             # for already aborted transfers
             print "(2) ignoring incoming file data block for canceled receiver"
             return
 
+        md5 = hashlib.md5(data)
+        hash2 = md5.hexdigest()
+        if hash != hash2:
+            print "(3) receiver wrong hash %i len: %i" % (start, len(data))
+            self.requestMissing(start, start + self.block_size)
+            return
+
+        end = start + len(data)
         if start > self.next_start:
-            if self.wrong_block_number_count == 0:
-                #not on every single out-of-order block in a row
-                #we must send an error message...
-                msg = ProtocolMsg_filedata_error(self.buddy, (self.id, self.next_start))
-                msg.send()
-                self.wrong_block_number_count += 1
-                #...only every 16
-                #FIXME: This must be solved more elegantly
-                if self.wrong_block_number_count == 16:
-                    self.wrong_block_number_count = 0
+            #blocks have been skipped/lost (temporary disconnect).
+            #we keep this one anyways and only ask for the gap.
+            self.requestMissing(self.next_start, start)
+
+        self.received_lock.acquire()
+        new = not self.received.contains(start, end)
+        if new:
+            self.received.add(start, end)
+        complete = self.received.getSize()
+        self.received_lock.release()
+        if new:
+            #(blocks that are sent again might already be here)
+            self.buddy.bl.disk_writer.write(self, start, data)
+            self.block_hashes[start // self.block_size] = md5.digest()
+        self.next_start = max(self.next_start, end)
+        if complete == self.file_size and self.file_digest and not self.verified:
+            if not self.verify():
+                self.onDamaged()
+                return
+            self.verified = True
+        msg = ProtocolMsg_filedata_ok(self.buddy, (self.id, start))
+        msg.send()
+        self.gui(self.file_size, complete)
+
+    def onDigest(self, digest, content_digest=None):
+        # (the sender sends it before the last block)
+        self.file_digest = digest
+        if content_digest and not self.content_digest:
+            self.content_digest = content_digest
+            if self.buddy.bl.content_index.isEnabled() \
+            and self.received.getSize() < self.file_size:
+                LocalCopyThread(self, content_digest)
+
+    def copyLocal(self, file_name):
+        """we have the file already, copy everything that we haven't
+        received yet from there and tell the sender we are complete"""
+        print "(2) FileReceiver: copying %s from local file %s" % (self.file_name, file_name)
+        self.received_lock.acquire()
+        missing = self.received.getMissing(0, self.file_size)
+        self.received_lock.release()
+        source = open(file_name, "rb")
+        self.lock.acquire()
+        try:
+            if self.closed or self.damaged:
+                return
+            for start, end in missing:
+                source.seek(start)
+                while start < end:
+                    data = source.read(min(end - start, 1048576))
+                    if not data:
+                        raise IOError("%s has become shorter" % file_name)
+                    self.file_handle_tmp.seek(start)
+                    self.file_handle_tmp.write(data)
+                    start += len(data)
+            self.written.add(0, self.file_size)
+        finally:
+            self.lock.release()
+            source.close()
+        # the file in the index might have been changed meanwhile
+        if self.file_digest and not self.verify():
+            self.onDamaged()
+            return
+        self.verified = True
+        self.received_lock.acquire()
+        self.received.add(0, self.file_size)
+        self.received_lock.release()
+        self.checkpoint()
+        self.sendState()
+        self.gui(self.file_size, self.file_size)
+
+    def verify(self):
+        """compare the digest of the whole file with the one from
+        the sender, see FileHasher. The md5s of the blocks received
+        in this session are known already, only the blocks from
+        before a restart must be read from the temp file again"""
+        whole = hashlib.sha256()
+        blocks = max(1, (self.file_size + self.block_size - 1) // self.block_size)
+        for index in xrange(blocks):
+            hash = self.block_hashes.get(index)
+            if hash is None:
+                #(the DiskWriter uses the same file handle)
+                self.lock.acquire()
+                try:
+                    self.file_handle_tmp.seek(index * self.block_size)
+                    hash = hashlib.md5(self.file_handle_tmp.read(self.block_size)).digest()
+                finally:
+                    self.lock.release()
+            whole.update(hash)
+        return whole.hexdigest() == self.file_digest
+
+    def onDamaged(self):
+        #the file must have been changed on the sender's disk
+        #during the transfer, it is of no use for anybody
+        print "(1) FileReceiver: digest of %s does not match, discarding it" % self.file_name
+        self.abort("file digest mismatch")
+
+    def onWriteError(self, error):
+        #(called by the DiskWriter) the blocks are confirmed already
+        #but could not be written, we can't continue
+        print "(1) FileReceiver: could not write %s: %s" % (self.file_name_tmp, error)
+        self.abort("error")
+
+    def abort(self, error_msg):
+        self.damaged = True
+        msg = ProtocolMsg_file_stop_sending(self.buddy, self.id)
+        msg.send()
+        self.discardData()
+        self.close()
+        self.gui(self.file_size, -1, error_msg)
+
+    def checkpoint(self):
+        """make sure everything that has been written so far is on the
+        disk and remember it in the journal, only these ranges will be
+        reported to the sender when resuming after a restart. This is
+        done by the DiskWriter every checkpoint_interval seconds"""
+        if self.buddy.lacksCapability(CAP_RESUME):
             return
+        self.lock.acquire()
+        try:
+            if not self.closed and not self.discarded:
+                self.last_checkpoint = time.time()
+                self.file_handle_tmp.flush()
+                os.fsync(self.file_handle_tmp.fileno())
+                self.buddy.bl.journal.set("receive", self.buddy.address, self.id, {
+                    "file_name" : self.file_name,
+                    "file_size" : self.file_size,
+                    "block_size" : self.block_size,
+                    "tmp" : config.toUnicode(self.file_name_tmp),
+                    "received" : self.written.getIntervals()})
+        except:
+            tb()
+        self.lock.release()
 
-        self.wrong_block_number_count = 0
-        hash2 = hashlib.md5(data).hexdigest()
-        if hash == hash2:
-            self.file_handle_tmp.seek(start)
-            self.file_handle_tmp.write(data)
-            self.next_start = start + len(data)
-            msg = ProtocolMsg_filedata_ok(self.buddy, (self.id, start))
-            msg.send()
-            self.gui(self.file_size, start + len(data))
+    def sendState(self):
+        """tell a (resuming) sender which ranges we already have"""
+        # (a sender that has just reconnected after a restart might be
+        # faster with its filename than with its version message)
+        if self.buddy.lacksCapability(CAP_RESUME):
+            return
+        self.received_lock.acquire()
+        positions = [pos for interval in self.received.getIntervals() for pos in interval]
+        self.received_lock.release()
+        msg = ProtocolMsg_filedata_received(self.buddy, [self.id] + positions)
+        msg.send()
 
+    def requestMissing(self, start, end):
+        if self.buddy.hasCapability(CAP_SELECTIVE_RESEND):
+            msg = ProtocolMsg_filedata_error(self.buddy, (self.id, start, end))
         else:
-            print "(3) receiver wrong hash %i len: %i" % (start, len(data))
-            msg = ProtocolMsg_filedata_error(self, (self.id, start))
-            msg.send()
-            #we try to avoid unnecessary wrong-block-number errors
-            #the next block sure will be out of order, but we have sent
-            #an error already because of the wrong hash
-            self.wrong_block_number_count = 1
+            #old senders can only restart everything at start
+            msg = ProtocolMsg_filedata_error(self.buddy, (self.id, start))
+        msg.send()
 
     def setFileNameSave(self, file_name_save):
         self.file_name_save = file_name_save
+        if os.path.abspath(file_name_save) == os.path.abspath(self.file_name_tmp):
+            #resumed after a restart, we were already writing to it
+            self.file_handle_save = self.file_handle_tmp
+            self.direct = True
+            return
         try:
-            self.file_handle_save = open(file_name_save, "w")
+            self.file_handle_save = open(file_name_save, "w+b")
             print "(2) created and opened placeholder file %s" % self.file_name_save
         except:
             self.file_handle_save = None
             self.file_name_save = None
             self.file_save_error = str(sys.exc_info()[1])
             print "(2) %s could not be created: %s" % (self.file_name_save, self.file_save_error)
+            return
+        if config.getint("files", "write_direct"):
+            self.writeDirect()
+
+    def writeDirect(self):
+        """use the placeholder file instead of the temp file as long
+        as nothing has been written to the temp file, this saves
+        copying and wiping the temp file after the transfer"""
+        self.lock.acquire()
+        try:
+            if self.written.getSize() or self.closed:
+                return
+            file_name_tmp, file_handle_tmp = self.file_name_tmp, self.file_handle_tmp
+            self.file_name_tmp = self.file_name_save
+            self.file_handle_tmp = self.file_handle_save
+            self.direct = True
+        finally:
+            self.lock.release()
+        file_handle_tmp.close()
+        os.unlink(file_name_tmp) #its still empty, no wiping needed
+        print "(2) writing directly to %s" % self.file_name_save
+        self.checkpoint()
+
+    def discardData(self):
+        """the transfer is given up. What the DiskWriter still has for us
+        must be dropped before the save file is closed, with write_direct
+        that's the file it is writing to"""
+        self.lock.acquire()
+        try:
+            self.discarded = True
+            self.buddy.bl.disk_writer.cancel(self)
+            if self.file_name_save:
+                self.discardSaveFile()
+        finally:
+            self.lock.release()
+
+    def discardSaveFile(self):
+        self.file_handle_save.close()
+        if self.direct:
+            #this is where our data is, close() will wipe it
+            self.direct = False
+        else:
+            print "(2) unlinking empty placeholder file %s" % self.file_name_save
+            os.unlink(self.file_name_save) #its still empty, no wiping needed
+        self.file_name_save = ""
+
+    def moveToSave(self):
+        """move the temp file to file_name_save, only when they are on
+        different file systems it must be copied and wiped"""
+        try:
+            if sys.platform == "win32":
+                #(windows can't rename to an existing file)
+                os.unlink(self.file_name_save)
+            os.rename(self.file_name_tmp, self.file_name_save)
+            print "(2) moved file to %s" % self.file_name_save
+        except OSError:
+            shutil.copy(self.file_name_tmp, self.file_name_save)
+            print "(2) copied file to %s" % self.file_name_save
+            print "(2) wiping received temporary file data"
+            wipeFile(self.file_name_tmp)
 
     def sendStopMessage(self):
         msg = ProtocolMsg_file_stop_receiving(self.buddy, self.id)
@@ -1161,11 +3172,7 @@ class FileReceiver(object):
         except:
             pass
         self.sendStopMessage()
-        if self.file_name_save:
-            self.file_handle_save.close()
-            print "(2) unlinking empty placeholder file %s" % self.file_name_save
-            os.unlink(self.file_name_save) #its still empty, no wiping needed
-            self.file_name_save = ""
+        self.discardData()
         self.close()
 
     def close(self):
@@ -1178,17 +3185,31 @@ class FileReceiver(object):
 
         if self.closed:
             return
+        #everything must be written before the file is closed
+        self.buddy.bl.disk_writer.remove(self)
+        if self.closed:
+            #(a write error has closed us meanwhile)
+            return
         try:
+            self.lock.acquire()
             self.closed = True
+            self.lock.release()
             self.file_handle_tmp.close()
-            if self.file_name_save:
+            if self.direct:
+                print "(2) file has been written directly to %s" % self.file_name_save
+            elif self.file_name_save:
                 self.file_handle_save.close()
-                shutil.copy(self.file_name_tmp, self.file_name_save)
-                print "(2) copied file to %s" % self.file_name_save
-
-            print "(2) wiping received temporary file data"
-            wipeFile(self.file_name_tmp)
-            del self.buddy.bl.file_receiver[self.buddy.address, self.id]
+                self.moveToSave()
+            else:
+                print "(2) wiping received temporary file data"
+                wipeFile(self.file_name_tmp)
+            bl = self.buddy.bl
+            del bl.file_receiver[self.buddy.address, self.id]
+            bl.journal.remove("receive", self.buddy.address, self.id)
+            if self.received.getSize() == self.file_size and not self.damaged:
+                bl.addFileReceived(self.buddy.address, self.id, self.file_size)
+                if self.content_digest and self.file_name_save:
+                    bl.content_index.add(self.content_digest, self.file_name_save)
         except:
             tb() #TODO: what could go wrong here? Why did I use try/except?
 
@@ -1204,17 +3225,17 @@ def ProtocolMsgFromLine(bl, conn, line):
     # is in the following form (which I call the "line")
     # <command>0x20<encoded>
     # we split it at the first space character (0x20)
-    command, encoded = splitLine(line)
+    pos = line.find(" ")
+    if pos < 0:
+        command, start = line, len(line)
+    else:
+        command, start = line[:pos], pos + 1
     
-    # encoded is a string of encoded binary data.
-    # The constructor will decode and parse it and we can return 
+    # line[start:] is a string of encoded binary data.
+    # fromLine() will decode and parse it and we can return 
     # a readily initialized message object. 
-    try:
-        Msg = globals()["ProtocolMsg_%s" % command]
-    except:
-        Msg = ProtocolMsg
-    
-    return Msg(bl, conn, command, encoded)
+    Msg = PROTOCOL_MESSAGES.get(command, ProtocolMsg)
+    return Msg.fromLine(bl, conn, command, line, start)
 
 
 class ProtocolMsg(object):
@@ -1223,8 +3244,13 @@ class ProtocolMsg(object):
 
     Besides being the base class for all ProtocolMsg_* classes
     this class is also instantiated for every unknown incoming message.
-    in this case execute() will simply reply with not_implemented"""
+    in this case execute() will simply reply with not_implemented
     
+    All message classes must declare __slots__ for the attributes
+    they set in parse(), there is one of these objects created
+    for every received line."""
+    __slots__ = ("bl", "buddy", "connection", "command", "blob")
+
     def __init__(self, *args):
         """ this is actually a few overloaded constructors, 
         depending on the types of argumments
@@ -1247,7 +3273,8 @@ class ProtocolMsg(object):
         # incoming
         #
         #__init__(self, bl, connection, command, encoded)
-        if type(args[0]) == BuddyList:
+        #(the receiver uses the faster fromLine() instead)
+        if isinstance(args[0], BuddyList):
             self.bl = args[0]
             self.connection = args[1]
             if self.connection:
@@ -1256,8 +3283,7 @@ class ProtocolMsg(object):
             
             # decode from line format to raw binary
             # and then let the message parse it 
-            self.blob = decodeLF(args[3])
-            self.parse()
+            self.parseLine(args[3], 0)
             
             # the incoming message is now properly initialized and somebody
             # could now call its execute() method to trigger its action
@@ -1269,16 +3295,16 @@ class ProtocolMsg(object):
         #
         #__init__(self, connection, blob)
         #__init__(self, buddy, blob)
-        if type(args[0]) in [InConnection, OutConnection, Buddy]:
-            if type(args[0]) in [InConnection, OutConnection]:
+        if isinstance(args[0], (InConnection, OutConnection, Buddy)):
+            if isinstance(args[0], Buddy):
+                self.buddy = args[0]
+                self.connection = self.buddy.conn_out
+                
+            else:
                 self.connection = args[0]
                 if self.connection.buddy:
                     self.buddy = self.connection.buddy
                 
-            elif type(args[0]) == Buddy:
-                self.buddy = args[0]
-                self.connection = self.buddy.conn_out
-                
             if len(args) > 1:
                 blob = args[1]
                 if type(blob) in [list, tuple]:
@@ -1290,6 +3316,28 @@ class ProtocolMsg(object):
             
             self.command = type(self).__name__[12:]
 
+    @classmethod
+    def fromLine(cls, bl, connection, command, line, start):
+        """construct an incoming message without going through the
+        overloaded constructor and its type checks. The encoded
+        data of the message begins at line[start]"""
+        self = cls.__new__(cls)
+        self.bl = bl
+        self.connection = connection
+        if connection:
+            self.buddy = connection.buddy
+        else:
+            self.buddy = None
+        self.command = command
+        self.parseLine(line, start)
+        return self
+
+    def parseLine(self, line, start):
+        """decode from line format to raw binary and then let the
+        message parse it. Messages that transport large amounts of
+        data can override this to parse the encoded line directly"""
+        self.blob = decodeLF(line[start:])
+        self.parse()
 
     def parse(self):
         pass
@@ -1342,6 +3390,8 @@ class ProtocolMsg(object):
 class ProtocolMsg_not_implemented(ProtocolMsg):
     """This message is sent whenever we cannot understand the command. When
     receiving this we currently do nothing, except logging it to the debug log"""
+    __slots__ = ("offending_command",)
+
     def parse(self):
         self.offending_command = self.blob
     
@@ -1354,6 +3404,8 @@ class ProtocolMsg_ping(ProtocolMsg):
     """a ping message consists of sender address and a random string (cookie). 
     It must be answered with a pong message containing the same cookie to so that 
     the other side can undoubtedly identify the connection"""
+    __slots__ = ("address", "answer")
+
     def parse(self):
         self.address, self.answer = splitLine(self.blob)
 
@@ -1401,12 +3453,12 @@ class ProtocolMsg_ping(ProtocolMsg):
         # FIXME: Might this check disrupt legitimate conditions?
         #
         found = False
-        for buddy in self.bl.list + self.bl.incoming_buddies:
-            if buddy.conn_in:
-                if buddy.address == self.address:
-                    if buddy.conn_in != self.connection:
-                        found = True
-                        break
+        for buddy in (self.bl.getBuddyFromAddress(self.address),
+                      self.bl.getIncomingBuddyFromAddress(self.address)):
+            if buddy and buddy.conn_in:
+                if buddy.conn_in != self.connection:
+                    found = True
+                    break
         if found:
             print "(1) detected ping from %s on other connection." % self.address
             print "(1) last cookie %s" %buddy.conn_in.last_ping_cookie
@@ -1449,7 +3501,7 @@ class ProtocolMsg_ping(ProtocolMsg):
                 #create it and put it in the temporary list
                 print "(2) %s is new. creating a temporary buddy instance" % self.address
                 self.buddy = Buddy(self.address, self.bl, temporary=True)
-                self.bl.incoming_buddies.append(self.buddy)
+                self.bl.addIncomingBuddy(self.buddy)
             else:
                 print "(2) %s is already in the incoming list" % self.address
                 print "(2) %s status is %i" % (self.address, self.buddy.status)
@@ -1482,11 +3534,12 @@ class ProtocolMsg_ping(ProtocolMsg):
         answer = ProtocolMsg_pong(self.buddy, self.answer)
         answer.send()
         self.buddy.conn_out.pong_sent = True
+        self.buddy.notifyFileSenders()
 
         self.buddy.sendVersion()
         self.buddy.sendProfile()
         self.buddy.sendAvatar()
-        if self.buddy in self.bl.list:
+        if self.bl.isOnList(self.buddy):
             self.buddy.sendAddMe()
 
         #send status as the last message because the other
@@ -1502,6 +3555,8 @@ class ProtocolMsg_pong(ProtocolMsg):
     corresponding pongs come in on which connections.
     we search all our known buddies for the corresponding random
     cookie to identify which buddy is replying here."""
+    __slots__ = ("cookie",)
+
     def parse(self):
         self.cookie = self.blob
         
@@ -1539,6 +3594,8 @@ class ProtocolMsg_pong(ProtocolMsg):
 
 class ProtocolMsg_client(ProtocolMsg):
     """transmits the name of the client software. Usually sent after the pong"""
+    __slots__ = ("client",)
+
     def parse(self):
         self.client = self.blob
 
@@ -1546,10 +3603,33 @@ class ProtocolMsg_client(ProtocolMsg):
         if self.buddy:
             print "(2) %s is using %s" % (self.buddy.address, self.client)
             self.buddy.client = self.client
+            # it might have been restarted with a different client,
+            # its capabilities (if any) and its version will follow
+            self.buddy.capabilities = set()
+            self.buddy.version = ""
+
+
+class ProtocolMsg_capabilities(ProtocolMsg):
+    """the protocol features (see CAPABILITIES) that the client knows,
+    separated by spaces. Sent after the 'client' message and before
+    the 'version' message, so when the version arrives we know them.
+    Old clients will answer with not_implemented, that's ok. Unknown
+    capabilities must be ignored"""
+    __slots__ = ("capabilities",)
+
+    def parse(self):
+        self.capabilities = set(self.blob.split())
+
+    def execute(self):
+        if self.buddy:
+            print "(2) %s knows %s" % (self.buddy.address, " ".join(self.capabilities))
+            self.buddy.capabilities = self.capabilities
 
 
 class ProtocolMsg_version(ProtocolMsg):
     """transmits the version number of the client software. Usually sent after the 'client' message"""
+    __slots__ = ("version",)
+
     def parse(self):
         self.version = self.blob
 
@@ -1557,6 +3637,7 @@ class ProtocolMsg_version(ProtocolMsg):
         if self.buddy:
             print "(2) %s has version %s" % (self.buddy.address, self.version)
             self.buddy.version = self.version
+            self.buddy.notifyFileSenders()
 
 
 class ProtocolMsg_status(ProtocolMsg):
@@ -1567,6 +3648,8 @@ class ProtocolMsg_status(ProtocolMsg):
     connection, immediately on every status change or at least 
     once every 120 seconds. Allowed values for the data are
     "avalable", "away", "xa", other values are not defined yet"""
+    __slots__ = ("status",)
+
     def parse(self):
         self.status = self.blob
         
@@ -1594,6 +3677,8 @@ class ProtocolMsg_status(ProtocolMsg):
 
 class ProtocolMsg_profile_name(ProtocolMsg):
     """transmit the name that is set in the pofile (this message is optional)"""
+    __slots__ = ("name",)
+
     def parse(self):
         self.name = self.blob.decode("UTF-8")
         
@@ -1605,6 +3690,8 @@ class ProtocolMsg_profile_name(ProtocolMsg):
 
 class ProtocolMsg_profile_text(ProtocolMsg):
     """transmit the text that is set in the pofile (this message is optional)"""
+    __slots__ = ("text",)
+
     def parse(self):
         self.text = self.blob.decode("UTF-8")
         
@@ -1621,6 +3708,8 @@ class ProtocolMsg_profile_avatar_alpha(ProtocolMsg):
     this message must be sent with empty data (0 bytes) if there
     is no alpha, it may not be omitted if you have an avatar.
     It CAN be omitted only if you also omit profile_avatar"""
+    __slots__ = ("bitmap",)
+
     def parse(self):
         if len(self.blob) == 4096 or len(self.blob) == 0:
             self.bitmap = self.blob
@@ -1641,6 +3730,8 @@ class ProtocolMsg_profile_avatar(ProtocolMsg):
     """the uncompesseed 64*64*24bit image. Avatar messages can 
     be completely omitted but IF they are sent then the correct 
     order is first the alpha and then this one"""
+    __slots__ = ("bitmap",)
+
     def parse(self):
         if len(self.blob) == 12288 or len(self.blob) == 0:
             self.bitmap = self.blob
@@ -1663,10 +3754,12 @@ class ProtocolMsg_add_me(ProtocolMsg):
     on the other's buddy list. Since a client can also connect for 
     the purpose of joining a chat room without automatically appearing 
     on the buddy list this message is needed."""
+    __slots__ = ()
+
     def execute(self):
         if self.buddy:
             print "(2) add me from %s" % self.buddy.address
-            if not self.buddy in self.bl.list:
+            if not self.bl.isOnList(self.buddy):
                 print "(2) received add_me from new buddy %s" % self.buddy.address
                 self.buddy.name = self.buddy.profile_name
                 self.bl.addBuddy(self.buddy)
@@ -1680,10 +3773,12 @@ class ProtocolMsg_remove_me(ProtocolMsg):
     automatically add itself again and cause annoyance. When removing
     a buddy first send this message before disconnecting or the other
     client will never know about it and add itself again next time"""
+    __slots__ = ()
+
     def execute(self):
         if self.buddy:
             print "(2) received remove_me from buddy %s" % self.buddy.address
-            if self.buddy in self.bl.list:
+            if self.bl.isOnList(self.buddy):
                 print "(2) removing %s from list" % self.buddy.address
                 self.bl.removeBuddy(self.buddy)
         else:
@@ -1694,6 +3789,8 @@ class ProtocolMsg_remove_me(ProtocolMsg):
 
 class ProtocolMsg_message(ProtocolMsg):
     """this is a normal text message. Text is encoded UTF-8"""
+    __slots__ = ("text",)
+
     def parse(self):
         self.text = self.blob.decode("UTF-8")
         self.text = self.text.replace("\r\n", "\n").replace("\r", "\n").replace("\x0b", "\n").replace("\n", os.linesep)
@@ -1702,7 +3799,7 @@ class ProtocolMsg_message(ProtocolMsg):
         #give buddy and text to bl. bl will then call into the gui
         #to open a chat window and/or display the text.
         if self.buddy:
-            if self.buddy in self.bl.list:
+            if self.bl.isOnList(self.buddy):
                 self.buddy.onChatMessage(self.text)
             else:
                 print "(1) ***** protocol violation reply to %s" % self.buddy.address
@@ -1712,8 +3809,9 @@ class ProtocolMsg_message(ProtocolMsg):
                 msg += "Make sure you have the latest version of TorChat"
                 msg += "and everything is configured correctly."
                 self.buddy.sendChatMessage(msg)
-                time.sleep(5)
-                self.buddy.disconnect()
+                # give the reply some time to go out (without
+                # blocking this connection's thread meanwhile)
+                self.bl.timer_wheel.callLater(5, self.buddy.disconnect)
 
         else:
             print "(2) received 'message' on unknown connection"
@@ -1725,6 +3823,8 @@ class ProtocolMsg_filename(ProtocolMsg):
     """The first message in a file transfer, initiating the transfer.
     Note that File transfer messages are the only messages that are allowed
     to be sent out on the incoming connection to avoid delaying of chat messages"""
+    __slots__ = ("id", "file_size", "block_size", "file_name")
+
     def parse(self):
         self.id, text = splitLine(self.blob) # each transfer has a unique ID, made up by the sender
         file_size, text = splitLine(text) # bytes
@@ -1755,14 +3855,36 @@ class ProtocolMsg_filename(ProtocolMsg):
             self.connection.close()
             return
 
+        #a sender that has reconnected or was restarted sends the
+        #filename again, it wants to know what we already have
+        receiver = self.bl.getFileReceiver(self.buddy.address, self.id)
+        if receiver:
+            receiver.sendState()
+            return
+        if (self.buddy.address, self.id) in self.bl.file_received:
+            #this one is finished already, only the confirmations got lost
+            msg = ProtocolMsg_filedata_received(self.buddy, (self.id, 0, self.file_size))
+            msg.send()
+            return
+        resume = self.bl.journal.get("receive", self.buddy.address, self.id)
+        if resume:
+            if resume["file_size"] != self.file_size \
+            or resume["file_name"] != self.file_name \
+            or not os.path.exists(resume["tmp"]):
+                resume = None
+
         #we create a file receiver instance which can deal with the
         #file data we expect to receive now. This obect will then
         #also notify the GUI and interact with it
-        FileReceiver(self.buddy,
-                     self.id,
-                     self.block_size,
-                     self.file_size,
-                     self.file_name)
+        receiver = FileReceiver(self.buddy,
+                                self.id,
+                                self.block_size,
+                                self.file_size,
+                                self.file_name,
+                                resume)
+        if not receiver.closed:
+            #(the GUI or its replacement might have refused it already)
+            receiver.sendState()
 
 
 class ProtocolMsg_filedata(ProtocolMsg):
@@ -1775,11 +3897,17 @@ class ProtocolMsg_filedata(ProtocolMsg):
     incoming ok messages (for example send the 5th block only after
     the 1st is confirmed, the 6th only after the 2nd confirmed, etc.,
     this number is only a wild guess and might need some tuning)"""
-    def parse(self):
-        self.id, text = splitLine(self.blob)
-        start, text = splitLine(text) # block start position in bytes
-        self.hash, self.data = splitLine(text) # md5
+    __slots__ = ("id", "start", "hash", "data")
+
+    def parseLine(self, line, start):
+        # the header fields are split off the still encoded line and the
+        # data is decoded from a buffer pointing into the line, so the
+        # block is copied at most once (only if it contains escapes)
+        # on its way from the Receiver to FileReceiver.data()
+        fields, data_start = splitFields(line, start, 3)
+        self.id, start, self.hash = fields # block start position in bytes, md5
         self.start = int(start)
+        self.data = decodeLF(buffer(line, data_start))
 
     def execute(self):
         if not self.buddy:
@@ -1801,14 +3929,39 @@ class ProtocolMsg_filedata(ProtocolMsg):
             msg.send()
 
 
+class ProtocolMsg_filedata_z(ProtocolMsg_filedata):
+    """The same as filedata but the data is compressed with zlib, the
+    hash is still the md5 of the original (uncompressed) block. The
+    sender can decide for every single block which one to send, this
+    one is only sent to clients that know it (see CAP_COMPRESSION)"""
+    __slots__ = ()
+
+    def parseLine(self, line, start):
+        ProtocolMsg_filedata.parseLine(self, line, start)
+        try:
+            # never unpack more than a block can have
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(self.data, FileSender.MAX_BLOCK_SIZE)
+            if decompressor.unconsumed_tail:
+                raise zlib.error("block is too large")
+            self.data = data
+        except zlib.error, e:
+            # the receiver will find the hash wrong and ask for it again
+            print "(2) could not decompress file block: %s" % e
+            self.data = ""
+
+
 class ProtocolMsg_filedata_ok(ProtocolMsg):
     """Every received "filedata" must be confirmed with a "filedata_ok"
     (or a "filedata_error") message. A File sender will use these messages
     to update the sending progress bar and to know that it can send more
     blocks"""
-    def parse(self):
-        self.id, start = splitLine(self.blob)
-        self.start = int(start) # block start position in bytes
+    __slots__ = ("id", "start")
+
+    def parseLine(self, line, start):
+        fields, start = splitFields(line, start, 1)
+        self.id = fields[0]
+        self.start = int(decodeLF(line[start:])) # block start position in bytes
 
     def execute(self):
         if self.buddy:
@@ -1832,16 +3985,28 @@ class ProtocolMsg_filedata_error(ProtocolMsg):
     was later than what we would have expected (entire blocks have been skipped/lost 
     due to temporary disconnect). A file sender must react to this message by 
     restarting the file transmission at the offset given in start. A file receiver will
-    send this message whenever it wants the the transfer restart at a certain position."""
-    def parse(self):
-        self.id, start = splitLine(self.blob)
-        self.start = int(start) # block start position in bytes
+    send this message whenever it wants the the transfer restart at a certain position.
+
+    Since rev18 there can be an end position after the start, then only the
+    blocks between start and end are missing and must be sent again. This
+    form is only sent to clients that know it (see CAP_SELECTIVE_RESEND)"""
+    __slots__ = ("id", "start", "end")
+
+    def parseLine(self, line, start):
+        fields, start = splitFields(line, start, 1)
+        self.id = fields[0]
+        positions = decodeLF(line[start:]).split(" ")
+        self.start = int(positions[0]) # block start position in bytes
+        if len(positions) > 1:
+            self.end = int(positions[1])
+        else:
+            self.end = None
 
     def execute(self):
         if self.buddy:
             sender = self.bl.getFileSender(self.buddy.address, self.id)
             if sender:
-                sender.restart(self.start)
+                sender.onError(self.start, self.end)
             else:
                 msg = ProtocolMsg_file_stop_receiving(self.buddy, self.id)
                 msg.send()
@@ -1851,11 +4016,74 @@ class ProtocolMsg_filedata_error(ProtocolMsg):
             self.connection.close()
 
 
+class ProtocolMsg_filedata_received(ProtocolMsg):
+    """A file receiver answers a repeated filename message (the sender has
+    reconnected or was restarted and wants to resume the transfer) with the
+    start and end of all ranges of the file it already has. The sender must
+    take this as the complete list of confirmed blocks and send everything
+    else (again). Only sent to clients that know it (see CAP_RESUME)"""
+    __slots__ = ("id", "intervals")
+
+    def parse(self):
+        fields = self.blob.split(" ")
+        self.id = fields[0]
+        positions = [int(pos) for pos in fields[1:]]
+        self.intervals = zip(positions[0::2], positions[1::2])
+
+    def execute(self):
+        if self.buddy:
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if sender:
+                sender.onReceiverState(self.intervals)
+            else:
+                msg = ProtocolMsg_file_stop_receiving(self.buddy, self.id)
+                msg.send()
+        else:
+            print "(2) received 'filedata_received' on unknown connection"
+            print "(2) unknown connection had '%s' in last ping. closing" % self.connection.last_ping_address
+            self.connection.close()
+
+
+class ProtocolMsg_filedigest(ProtocolMsg):
+    """The sender sends this as soon as it has read the whole file once,
+    always before the last filedata and again after every repeated
+    filename. digest is the sha256 (hex) over the binary md5s of all
+    blocks of the file in their order (the same md5s that are in the
+    filedata messages, an empty file has one empty block). The receiver
+    verifies it when it has the complete file. Only sent to clients that
+    know it (see CAP_FILE_DIGEST)
+
+    It can be followed by the content hash, the sha256 (hex) of the file
+    itself. If the receiver has a file with this content hash already it
+    can copy it and answer with a filedata_received for the whole file"""
+    __slots__ = ("id", "digest", "content_digest")
+
+    def parse(self):
+        fields = self.blob.split(" ")
+        self.id, self.digest = fields[:2]
+        if len(fields) > 2:
+            self.content_digest = fields[2]
+        else:
+            self.content_digest = None
+
+    def execute(self):
+        if self.buddy:
+            receiver = self.bl.getFileReceiver(self.buddy.address, self.id)
+            if receiver:
+                receiver.onDigest(self.digest, self.content_digest)
+        else:
+            print "(2) received 'filedigest' on unknown connection"
+            print "(2) unknown connection had '%s' in last ping. closing" % self.connection.last_ping_address
+            self.connection.close()
+
+
 class ProtocolMsg_file_stop_sending(ProtocolMsg):
     """A file receiver sends this to make the file sender stop sending,
     a file sender must react to this message by stopping the file sending,
     the GUI should notify the user that the receiver has canceled. This
     message usually occurs when a file receiver clicks the cancel button"""
+    __slots__ = ("id",)
+
     def parse(self):
         self.id = self.blob
 
@@ -1879,6 +4107,8 @@ class ProtocolMsg_file_stop_receiving(ProtocolMsg):
     regarding the same transfer can be expected after this, all allocated
     resources regarding this transfer can be freed, incomplete temp files 
     should be wiped and the user notified about the cancel."""
+    __slots__ = ("id",)
+
     def parse(self):
         self.id = self.blob
 
@@ -1895,50 +4125,120 @@ class ProtocolMsg_file_stop_receiving(ProtocolMsg):
             self.connection.close()
 
 
+def buildProtocolRegistry():
+    """map every command to its ProtocolMsg_* class. This is
+    done only once at import time, ProtocolMsgFromLine() then
+    only needs one dictionary lookup per received line"""
+    registry = {}
+    for name, obj in globals().items():
+        if name.startswith("ProtocolMsg_") and isinstance(obj, type) \
+        and issubclass(obj, ProtocolMsg):
+            registry[name[12:]] = obj
+    return registry
+
+PROTOCOL_MESSAGES = buildProtocolRegistry()
+
+
 #--- ### Low level network stuff
 
+def processLine(conn, line, is_incoming):
+    """parse and execute one received line. This is used by the
+    Receiver threads and by the Reactor, so both network engines
+    will dispatch the incoming protocol messages exactly the same way"""
+    try:
+        # on outgoing connections we do not allow any
+        # incoming messages other than file*
+        # this prevents an attacker from messaging
+        # or sending commands before the handshake is
+        # completed or pong on the wrong connection
+        if (is_incoming or line[:4] == "file"):
+            message = ProtocolMsgFromLine(conn.bl, conn, line)
+            message.execute()
+        else:
+            # this is an outgoing connection. Incoming protocol messages are ignored
+            print "(1) received unexpected '%s' on outgoing connection to %s" % (line, conn.buddy.address)
+    except:
+        tb()
+
+
+class LineTooLongError(Exception):
+    pass
+
+
+class LineFramer(object):
+    """Cuts the received byte stream into lines. The data is collected
+    in a bytearray and only the newly received bytes are searched for
+    the delimiter, so a long line (a filedata message for example) that
+    is arriving in many small chunks is not copied and scanned again
+    and again on every recv(). Each complete line is copied exactly
+    once when it is returned. The old readbuffer + recv and split()
+    was quadratic in the length of the line."""
+    def __init__(self, max_line_length=0):
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.max_line_length = max_line_length
+
+    def feed(self, data):
+        """append received data and return a list of all lines that
+        are now complete (without the delimiter). Raises LineTooLongError
+        if the incomplete line exceeds max_line_length"""
+        buf = self.buffer
+        buf.extend(data)
+        lines = []
+        start = 0
+        pos = buf.find("\n", self.scanned)
+        if pos != -1:
+            view = memoryview(buf)
+            while pos != -1:
+                lines.append(view[start:pos].tobytes())
+                start = pos + 1
+                pos = buf.find("\n", start)
+            # the bytearray cannot be resized while the view exists
+            del view
+            del buf[:start]
+        self.scanned = len(buf)
+        if self.max_line_length and self.scanned > self.max_line_length:
+            raise LineTooLongError("incomplete line exceeds %i bytes" % self.max_line_length)
+        return lines
+
+    def getPending(self):
+        """number of bytes of the incomplete line"""
+        return len(self.buffer)
+
+
+def createLineFramer():
+    return LineFramer(config.getint("client", "max_line_length"))
+
+
 class Receiver(threading.Thread):
     def __init__(self, conn, is_incoming=False):
         threading.Thread.__init__(self)
         self.conn = conn
         self.is_incoming = is_incoming
         self.socket = conn.socket
+        self.recv_size = config.getint("client", "recv_size") or 4096
+        self.framer = createLineFramer()
         self.running = True
         self.start()
 
     def run(self):
-        readbuffer = ""
         #self.socket.settimeout(5)
         while self.running:
             try:
-                recv = self.socket.recv(4096)
+                recv = self.socket.recv(self.recv_size)
                 if recv != "":
-                    readbuffer = readbuffer + recv
-                    temp = readbuffer.split("\n")
-                    readbuffer = temp.pop()
-
-                    for line in temp:
+                    for line in self.framer.feed(recv):
                         if self.running:
-                            try:
-                                # on outgoing connections we do not allow any
-                                # incoming messages other than file*
-                                # this prevents an attacker from messaging
-                                # or sending commands before the handshake is
-                                # completed or pong on the wrong connection
-                                if (self.is_incoming or line[:4] == "file"):
-                                    message = ProtocolMsgFromLine(self.conn.bl,
-                                                              self.conn,
-                                                              line)
-                                    message.execute()
-                                else:
-                                    # this is an outgoing connection. Incoming protocol messages are ignored
-                                    print "(1) received unexpected '%s' on outgoing connection to %s" % (line, self.conn.buddy.address)
-                            except:
-                                tb()
+                            processLine(self.conn, line, self.is_incoming)
                 else:
                     self.running = False
                     self.conn.onReceiverError()
 
+            except LineTooLongError:
+                print "(1) %s, closing connection" % sys.exc_info()[1]
+                self.running = False
+                self.conn.onReceiverError()
+
             except socket.timeout:
                 self.running = False
                 self.conn.onReceiverError()
@@ -1948,6 +4248,54 @@ class Receiver(threading.Thread):
                 self.conn.onReceiverError()
 
 
+class SendQueue(object):
+    """Thread safe queue for outgoing lines. The writing thread sleeps
+    in get() until something has been queued (or the queue is closed),
+    there is no polling. All lines that have accumulated in the meantime
+    are returned at once so they can go out with only one sendall()"""
+    def __init__(self):
+        self.lines = []
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, text):
+        self.condition.acquire()
+        if not self.closed:
+            self.lines.append(text)
+            self.condition.notify()
+        self.condition.release()
+
+    def take(self):
+        """return all queued lines as one string and empty the
+        queue. Does not block, returns "" if there is nothing"""
+        self.condition.acquire()
+        text = "".join(self.lines)
+        self.lines = []
+        self.condition.release()
+        return text
+
+    def get(self):
+        """block until there is something to send and then take() it.
+        Returns None after the queue has been closed."""
+        self.condition.acquire()
+        while not self.lines and not self.closed:
+            self.condition.wait()
+        self.condition.release()
+        if self.closed:
+            return None
+        return self.take()
+
+    def close(self):
+        self.condition.acquire()
+        self.closed = True
+        self.lines = []
+        self.condition.notifyAll()
+        self.condition.release()
+
+    def isEmpty(self):
+        return not self.lines
+
+
 class InConnection(object):
     def __init__(self, socket, buddy_list):
         self.buddy = None
@@ -1957,11 +4305,19 @@ class InConnection(object):
         self.last_ping_cookie = "" #used to detect pings with fake cookies
         self.last_active = time.time()
         self.started = True
-        self.receiver = Receiver(self, True)
+        if self.bl.reactor:
+            # no thread needed, the reactor will read from this socket
+            self.receiver = None
+            self.bl.reactor.addConnection(self, True)
+        else:
+            self.receiver = Receiver(self, True)
 
     def send(self, text):
+        if self.bl.reactor:
+            self.bl.reactor.send(self, text)
+            return
         try:
-            self.socket.send(text)
+            self.socket.sendall(text)
         except:
             tb()
             print "(2) in-connection send error."
@@ -1980,14 +4336,18 @@ class InConnection(object):
     def close(self):
         print "(2) in-connection closing %s" % self.last_ping_address
 
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except:
-            print "(3) socket.shutdown() %s" % sys.exc_info()[1]
-        try:
-            self.socket.close()
-        except:
-            print "(3) socket.close() %s" % sys.exc_info()[1]
+        if self.bl.reactor:
+            # the reactor will close the socket from within its own thread
+            self.bl.reactor.removeConnection(self)
+        else:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except:
+                print "(3) socket.shutdown() %s" % sys.exc_info()[1]
+            try:
+                self.socket.close()
+            except:
+                print "(3) socket.close() %s" % sys.exc_info()[1]
 
         self.started = False
         if self in self.bl.listener.conns:
@@ -2003,8 +4363,14 @@ class OutConnection(threading.Thread):
         self.buddy = buddy
         self.address = address
         self.pong_sent = False
-        self.send_buffer = []
-        self.start()
+        self.send_queue = SendQueue()
+        if self.bl.reactor:
+            # the reactor will do the connect and all the socket
+            # IO for us, the thread itself will never be started.
+            self.running = True
+            self.bl.reactor.addOutConnection(self)
+        else:
+            self.start()
 
     def run(self):
         self.running = True
@@ -2019,17 +4385,18 @@ class OutConnection(threading.Thread):
             self.bl.onConnected(self)
             self.receiver = Receiver(self, False) # this Receiver will only accept file* messages
             while self.running:
-                while len(self.send_buffer) > 0:
-                    text = self.send_buffer.pop(0)
-                    try:
-                        print "(2) %s out-connection sending buffer" % self.address
-                        self.socket.send(text)
-                    except:
-                        print "(2) out-connection send error"
-                        self.bl.onErrorOut(self)
-                        self.close()
-
-                time.sleep(0.2)
+                # this will sleep until there is something to send
+                # and then give us everything that is queued so far
+                text = self.send_queue.get()
+                if text is None:
+                    break # closed
+                try:
+                    print "(2) %s out-connection sending buffer" % self.address
+                    self.socket.sendall(text)
+                except:
+                    print "(2) out-connection send error"
+                    self.bl.onErrorOut(self)
+                    self.close()
 
         except:
             print "(2) out-connection to %s failed: %s" % (self.address, sys.exc_info()[1])
@@ -2037,7 +4404,10 @@ class OutConnection(threading.Thread):
             self.close()
 
     def send(self, text):
-        self.send_buffer.append(text)
+        if self.bl.reactor:
+            self.bl.reactor.send(self, text)
+        else:
+            self.send_queue.put(text)
 
     def onReceiverError(self):
         print "(2) out-connection receiver error"
@@ -2046,15 +4416,18 @@ class OutConnection(threading.Thread):
 
     def close(self):
         self.running = False
-        self.send_buffer = []
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except:
-            print "(3) socket.shutdown() %s" % sys.exc_info()[1]
-        try:
-            self.socket.close()
-        except:
-            print "(3) socket.close() %s" % sys.exc_info()[1]
+        self.send_queue.close()
+        if self.bl.reactor:
+            self.bl.reactor.removeConnection(self)
+        else:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except:
+                print "(3) socket.shutdown() %s" % sys.exc_info()[1]
+            try:
+                self.socket.close()
+            except:
+                print "(3) socket.close() %s" % sys.exc_info()[1]
 
         if self.buddy:
             self.buddy.conn_out = None
@@ -2069,27 +4442,38 @@ class Listener(threading.Thread):
         self.buddy_list = buddy_list
         self.conns = []
         self.socket = socket
-        self.start()
+        if buddy_list.reactor:
+            # the reactor will accept the connections, no thread needed
+            self.running = True
+            self.openSocket()
+            buddy_list.reactor.addListener(self)
+        else:
+            self.start()
         self.startTimer()
 
-    def run(self):
-        self.running = True
+    def openSocket(self):
         if not self.socket:
             interface = config.get("client", "listen_interface")
             port = config.getint("client", "listen_port")
             self.socket = tryBindPort(interface, port)
         self.socket.listen(5)
+
+    def run(self):
+        self.running = True
+        self.openSocket()
         while self.running:
             try:
                 conn, address = self.socket.accept()
-                self.conns.append(InConnection(conn, self.buddy_list))
-                print "(2) new incoming connection"
-                print "(2) have now %i incoming connections" % len(self.conns)
+                self.onAccept(conn)
             except:
                 print "socket listener error!"
                 tb()
                 self.running = False
 
+    def onAccept(self, conn):
+        self.conns.append(InConnection(conn, self.buddy_list))
+        print "(2) new incoming connection"
+        print "(2) have now %i incoming connections" % len(self.conns)
 
     def close(self):
         self.running = False
@@ -2097,15 +4481,17 @@ class Listener(threading.Thread):
             print "(2) closing listening socket %s:%s" \
               % (config.get("client", "listen_interface"),
                  config.get("client", "listen_port"))
-            self.socket.close()
+            if self.buddy_list.reactor:
+                self.buddy_list.reactor.removeListener(self)
+            else:
+                self.socket.close()
             print "(2) success"
         except:
             print "(2) closing socket failed, traceback follows:"
             tb()
 
     def startTimer(self):
-        self.timer = threading.Timer(30, self.onTimer)
-        self.timer.start()
+        self.timer = self.buddy_list.timer_wheel.callLater(30, self.onTimer)
 
     def onTimer(self):
         for conn in self.conns:
@@ -2122,6 +4508,475 @@ class Listener(threading.Thread):
         self.startTimer()
 
 
+#--- ### Single threaded network engine
+
+def isWouldBlock(error):
+    """true if the socket.error is just a non-blocking
+    socket telling us that it would have to block"""
+    return error.args and error.args[0] in (errno.EAGAIN,
+                                            errno.EWOULDBLOCK,
+                                            errno.EINPROGRESS,
+                                            errno.EINTR)
+
+def createSocketPair():
+    """return two connected sockets. Windows has no
+    socket.socketpair() so we connect them over loopback"""
+    try:
+        return socket.socketpair()
+    except (AttributeError, socket.error):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        a.connect(server.getsockname())
+        b, address = server.accept()
+        server.close()
+        return a, b
+
+
+class Poller(object):
+    """a minimal common interface for epoll, poll and select.
+    It uses the best one that is available on this platform,
+    on Windows this will always be select."""
+    def __init__(self):
+        self.masks = {}
+        if hasattr(select, "epoll"):
+            self.kind = "epoll"
+            self.impl = select.epoll()
+            self.READ = select.EPOLLIN
+            self.WRITE = select.EPOLLOUT
+            self.ERROR = select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, "poll"):
+            self.kind = "poll"
+            self.impl = select.poll()
+            self.READ = select.POLLIN
+            self.WRITE = select.POLLOUT
+            self.ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        else:
+            self.kind = "select"
+            self.impl = None
+            self.READ = 1
+            self.WRITE = 4
+            self.ERROR = 0
+
+    def register(self, fd, read, write):
+        mask = (read and self.READ) | (write and self.WRITE)
+        if self.impl:
+            self.impl.register(fd, mask)
+        self.masks[fd] = mask
+
+    def modify(self, fd, read, write):
+        mask = (read and self.READ) | (write and self.WRITE)
+        if self.masks.get(fd) != mask:
+            if self.impl:
+                self.impl.modify(fd, mask)
+            self.masks[fd] = mask
+
+    def unregister(self, fd):
+        if fd in self.masks:
+            del self.masks[fd]
+            if self.impl:
+                try:
+                    self.impl.unregister(fd)
+                except (IOError, OSError, KeyError):
+                    pass
+
+    def poll(self, timeout):
+        """wait for events and return a list of (fd, readable, writable)
+        tuples. Errors and hangups are reported as readable (and writable)
+        so the next recv() or send() on this socket will find out what
+        has happened."""
+        result = []
+        if self.kind == "select":
+            r = [fd for fd, mask in self.masks.iteritems() if mask & self.READ]
+            w = [fd for fd, mask in self.masks.iteritems() if mask & self.WRITE]
+            r, w, x = select.select(r, w, r, timeout)
+            w = set(w)
+            for fd in set(r + x):
+                result.append((fd, True, fd in w))
+                w.discard(fd)
+            for fd in w:
+                result.append((fd, False, True))
+            return result
+        if self.kind == "poll":
+            events = self.impl.poll(timeout * 1000)
+        else:
+            events = self.impl.poll(timeout)
+        for fd, event in events:
+            error = event & self.ERROR
+            result.append((fd,
+                           bool(event & self.READ or error),
+                           bool(event & self.WRITE or error)))
+        return result
+
+
+class ReactorChannel(object):
+    """everything the Reactor needs to know about one of its sockets"""
+    def __init__(self, conn, sock, is_incoming, state):
+        self.conn = conn
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.is_incoming = is_incoming
+        self.state = state # "listen", "connect", "socks" or "open"
+        self.open = True
+        self.registered = False
+        self.readbuffer = ""
+        self.framer = createLineFramer()
+        self.send_queue = SendQueue()
+        self.out_data = ""
+        self.out_offset = 0
+        self.socks_request = ""
+        self.paused = False # the DiskWriter is full, don't read
+
+    def hasOutput(self):
+        return self.out_offset < len(self.out_data) or not self.send_queue.isEmpty()
+
+
+class Reactor(threading.Thread):
+    """A single threaded alternative to the thread-per-socket network
+    engine. Instead of one Receiver thread per connection, one more
+    thread per OutConnection and one for the Listener this multiplexes
+    the listening socket, all incoming connections and all outgoing
+    SOCKS connections on only one thread, using epoll, poll or select.
+    It is enabled with io_engine = reactor in the [client] section.
+
+    Incoming lines are handed to processLine() exactly like Receiver
+    does it, so all ProtocolMsg objects are executed the same way, only
+    now they are all executed in the context of the reactor thread.
+    Connections can call send(), addConnection() and removeConnection()
+    from any thread, everything that touches the sockets themselves
+    will then be done by the reactor thread."""
+    POLL_TIMEOUT = 1
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.recv_size = config.getint("client", "recv_size") or 4096
+        self.poller = Poller()
+        self.channels = {}
+        self.calls = []
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.running = True
+        self.wakeup_out, self.wakeup_in = createSocketPair()
+        self.wakeup_out.setblocking(0)
+        self.wakeup_in.setblocking(0)
+        self.poller.register(self.wakeup_in.fileno(), True, False)
+        self.start()
+
+    def isReactorThread(self):
+        return threading.currentThread() is self
+
+    def wakeup(self):
+        if not self.isReactorThread():
+            try:
+                self.wakeup_out.send("x")
+            except socket.error:
+                pass # buffer full, it will wake up anyways
+
+    def callFromThread(self, function, *args):
+        """run function(*args) in the reactor thread. If we are
+        already in the reactor thread it will be called immediately"""
+        if self.isReactorThread():
+            function(*args)
+        else:
+            self.queueCall(function, *args)
+
+    def queueCall(self, function, *args):
+        """run function(*args) in the next iteration of the reactor loop"""
+        self.lock.acquire()
+        self.calls.append((function, args))
+        self.lock.release()
+        self.wakeup()
+
+    def runCalls(self):
+        self.lock.acquire()
+        calls = self.calls
+        self.calls = []
+        self.lock.release()
+        for function, args in calls:
+            try:
+                function(*args)
+            except:
+                tb()
+
+    def addListener(self, listener):
+        listener.socket.setblocking(0)
+        channel = ReactorChannel(listener, listener.socket, True, "listen")
+        listener.reactor_channel = channel
+        self.callFromThread(self.register, channel)
+
+    def removeListener(self, listener):
+        self.callFromThread(self.closeChannel, listener.reactor_channel)
+
+    def addConnection(self, conn, is_incoming):
+        """add an already connected socket"""
+        conn.socket.setblocking(0)
+        channel = ReactorChannel(conn, conn.socket, is_incoming, "open")
+        conn.reactor_channel = channel
+        self.callFromThread(self.register, channel)
+
+    def addOutConnection(self, conn):
+        """connect to the Tor SOCKS port and then ask Tor (SOCKS4a)
+        to connect us to the hidden service at conn.address"""
+        conn.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.socket.setblocking(0)
+        channel = ReactorChannel(conn, conn.socket, False, "connect")
+        channel.socks_request = "\x04\x01" \
+            + struct.pack(">H", TORCHAT_PORT) \
+            + "\x00\x00\x00\x01\x00" \
+            + str(conn.address) + "\x00"
+        conn.reactor_channel = channel
+        # always deferred, even when called from the reactor thread, the
+        # caller must be able to assign the connection before it can fail
+        self.queueCall(self.startConnect, channel)
+
+    def startConnect(self, channel):
+        print "(2) trying to connect '%s'" % channel.conn.address
+        proxy = (config.get(TOR_CONFIG, "tor_server"),
+                 config.getint(TOR_CONFIG, "tor_server_socks_port"))
+        err = channel.socket.connect_ex(proxy)
+        if err and err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            print "(2) out-connection to %s failed: %s" % (channel.conn.address, os.strerror(err))
+            self.onChannelError(channel)
+            return
+        self.register(channel)
+
+    def removeConnection(self, conn):
+        try:
+            channel = conn.reactor_channel
+        except AttributeError:
+            return
+        self.callFromThread(self.closeChannel, channel)
+
+    def send(self, conn, text):
+        channel = conn.reactor_channel
+        channel.send_queue.put(text)
+        self.markDirty(channel)
+        self.wakeup()
+
+    def markDirty(self, channel):
+        """the poller flags of this channel must be updated"""
+        self.lock.acquire()
+        self.dirty.add(channel)
+        self.lock.release()
+
+    def register(self, channel):
+        if channel.open:
+            self.channels[channel.fd] = channel
+            self.poller.register(channel.fd, self.wantRead(channel), self.wantWrite(channel))
+            channel.registered = True
+
+    def wantRead(self, channel):
+        if channel.paused:
+            return False
+        return channel.state in ("listen", "socks", "open")
+
+    def wantWrite(self, channel):
+        if channel.state == "connect":
+            return True
+        if channel.state == "socks":
+            return channel.socks_request != ""
+        if channel.state == "open":
+            return channel.hasOutput()
+        return False
+
+    def updateInterest(self):
+        self.lock.acquire()
+        dirty = self.dirty
+        self.dirty = set()
+        self.lock.release()
+        for channel in dirty:
+            if channel.open and channel.registered:
+                self.poller.modify(channel.fd, self.wantRead(channel), self.wantWrite(channel))
+
+    def closeChannel(self, channel):
+        if not channel.open:
+            return
+        if channel.state == "open" and channel.hasOutput():
+            # give pending data one last chance to go out
+            try:
+                self.flush(channel)
+            except socket.error:
+                pass
+        channel.open = False
+        channel.send_queue.close()
+        if channel.registered:
+            self.poller.unregister(channel.fd)
+            del self.channels[channel.fd]
+        if channel.state != "listen":
+            try:
+                channel.socket.shutdown(socket.SHUT_RDWR)
+            except:
+                print "(3) socket.shutdown() %s" % sys.exc_info()[1]
+        try:
+            channel.socket.close()
+        except:
+            print "(3) socket.close() %s" % sys.exc_info()[1]
+
+    def onChannelError(self, channel):
+        if channel.open:
+            self.closeChannel(channel)
+            channel.conn.onReceiverError()
+
+    def onAccept(self, channel):
+        try:
+            conn, address = channel.socket.accept()
+        except socket.error, e:
+            if not isWouldBlock(e):
+                print "socket listener error!"
+                tb()
+            return
+        channel.conn.onAccept(conn)
+
+    def onReadable(self, channel):
+        if channel.state == "listen":
+            self.onAccept(channel)
+            return
+        try:
+            recv = channel.socket.recv(self.recv_size)
+        except socket.error, e:
+            if isWouldBlock(e):
+                return
+            recv = ""
+        if recv == "":
+            self.onChannelError(channel)
+            return
+
+        if channel.state == "socks":
+            channel.readbuffer = channel.readbuffer + recv
+            if len(channel.readbuffer) < 8:
+                return
+            response = channel.readbuffer[:8]
+            recv = channel.readbuffer[8:]
+            channel.readbuffer = ""
+            if response[0] != "\x00" or response[1] != "\x5A":
+                print "(2) out-connection to %s failed: SOCKS error %i" % (channel.conn.address, ord(response[1]))
+                self.onChannelError(channel)
+                return
+            print "(2) connected to %s" % channel.conn.address
+            channel.state = "open"
+            self.markDirty(channel)
+            channel.conn.bl.onConnected(channel.conn)
+            if recv == "":
+                return
+
+        try:
+            lines = channel.framer.feed(recv)
+        except LineTooLongError:
+            print "(1) %s, closing connection" % sys.exc_info()[1]
+            self.onChannelError(channel)
+            return
+        for line in lines:
+            if channel.open:
+                processLine(channel.conn, line, channel.is_incoming)
+
+        # DiskWriter.write() does not wait for the disk in our thread,
+        # instead we stop reading from this connection until the disk
+        # has caught up, this will slow down the sender.
+        disk_writer = channel.conn.bl.disk_writer
+        if channel.open and not channel.paused and disk_writer.isFull():
+            channel.paused = True
+            self.markDirty(channel)
+            disk_writer.callWhenDrained(lambda: self.queueCall(self.resumeReading, channel))
+
+    def resumeReading(self, channel):
+        channel.paused = False
+        self.markDirty(channel)
+
+    def onWritable(self, channel):
+        if channel.state == "connect":
+            err = channel.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                print "(2) out-connection to %s failed: %s" % (channel.conn.address, os.strerror(err))
+                self.onChannelError(channel)
+                return
+            channel.state = "socks"
+
+        try:
+            if channel.state == "socks":
+                sent = channel.socket.send(channel.socks_request)
+                channel.socks_request = channel.socks_request[sent:]
+            elif channel.state == "open":
+                self.flush(channel)
+        except socket.error, e:
+            if not isWouldBlock(e):
+                print "(2) %s send error: %s" % (channel.conn, e)
+                self.onChannelError(channel)
+                return
+        self.markDirty(channel)
+
+    def flush(self, channel):
+        """send as much as possible, all queued lines will
+        be coalesced into one single send() call"""
+        if channel.out_offset >= len(channel.out_data):
+            channel.out_data = channel.send_queue.take()
+            channel.out_offset = 0
+        if channel.out_data:
+            sent = channel.socket.send(buffer(channel.out_data, channel.out_offset))
+            channel.out_offset += sent
+
+    def dropBadChannels(self):
+        """after a failed poll, find the sockets that are not valid
+        anymore (EBADF, closed behind our back), forget them and close
+        their connections. Returns True if there were any."""
+        found = False
+        for fd in self.poller.masks.keys():
+            if fd == self.wakeup_in.fileno():
+                continue
+            try:
+                select.select([fd], [], [], 0)
+            except (select.error, ValueError, TypeError):
+                print "(1) reactor: dropping invalid socket %s" % fd
+                found = True
+                self.poller.unregister(fd)
+                channel = self.channels.pop(fd, None)
+                if channel:
+                    channel.registered = False
+                    self.onChannelError(channel)
+        return found
+
+    def stop(self):
+        self.callFromThread(self.onStop)
+
+    def onStop(self):
+        for channel in self.channels.values():
+            self.closeChannel(channel)
+        self.running = False
+
+    def run(self):
+        print "(1) reactor started, using %s" % self.poller.kind
+        while self.running:
+            self.runCalls()
+            self.updateInterest()
+            try:
+                events = self.poller.poll(self.POLL_TIMEOUT)
+            except (select.error, IOError, OSError), e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                tb()
+                print "(0) reactor: poll failed: %s" % (e,)
+                if not self.dropBadChannels():
+                    # don't spin if the error does not go away
+                    time.sleep(self.POLL_TIMEOUT)
+                continue
+            for fd, readable, writable in events:
+                if fd == self.wakeup_in.fileno():
+                    try:
+                        self.wakeup_in.recv(4096)
+                    except socket.error:
+                        pass
+                    continue
+                channel = self.channels.get(fd)
+                try:
+                    if channel and writable and channel.open:
+                        self.onWritable(channel)
+                    if channel and readable and channel.open:
+                        self.onReadable(channel)
+                except:
+                    tb()
+        print "(1) reactor stopped"
+
+
 def tryBindPort(interface, port):
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+
+##############################################################################
+#                                                                            #
+# Copyright (c) 2007-2010 Bernd Kreuss <prof7bit@gmail.com>                  #
+#                                                                            #
+# This program is licensed under the GNU General Public License V3,          #
+# the full source code is included in the binary distribution.               #
+#                                                                            #
+# Included in the distribution are files from other open source projects:    #
+# - TOR Onion Router (c) The Tor Project, 3-clause-BSD                       #
+# - SocksiPy (c) Dan Haim, BSD Style License                                 #
+# - Gajim buddy status icons (c) The Gajim Team, GNU GPL                     #
+#                                                                            #
+##############################################################################
+
+
+# The line encoding of the TorChat protocol. Every protocol message is
+# transmitted as one "line" terminated by 0x0a, so the binary contents
+# of the message must not contain any 0x0a. This is done with a simple
+# escape code: every backslash is sent as the two bytes '\/' and every
+# 0x0a is sent as the two bytes '\n'. The explanation why it is done
+# this way can be found in tc_client.encodeLF().
+#
+# The old implementation did this with two str.replace() calls in each
+# direction, two passes and one intermediate string. Here the decoder
+# does it in one single pass with one compiled regular expression (or
+# returns the data without copying it at all if there is no backslash
+# in it, which is the case for most of the short messages). For short
+# data the overhead of the regex callbacks is bigger than a second pass
+# over a few hundred bytes, so below SHORT_DATA the replace() is kept. The
+# encoder still uses str.replace(), its C loops are more than an order
+# of magnitude faster than anything else that is available to us without
+# a compiled extension (run "python bench.py codec" to see the numbers),
+# escaping is only ever needed for a few bytes per kilobyte.
+
+import re
+
+UNESCAPE = {"\\/" : "\\", "\\n" : "\n"}
+
+RE_UNESCAPE = re.compile(r"\\[/n]")
+
+SHORT_DATA = 4096
+
+def _unescape(match):
+    return UNESCAPE[match.group()]
+
+def encode(blob):
+    """takes a string of 8 bit binary data and encodes
+    it so that there are no 0x0a (LF) bytes anymore"""
+    return blob.replace("\\", "\\/").replace("\n", "\\n")
+
+def decode(data):
+    """takes the encoded data as it comes from the socket (a string
+    or a buffer) and returns the original binary data as a string.
+    If there is nothing to decode the data is returned unchanged"""
+    if not "\\" in data:
+        return data
+    if len(data) < SHORT_DATA:
+        return str(data).replace("\\n", "\n").replace("\\/", "\\")
+    return RE_UNESCAPE.sub(_unescape, data)
@@ -0,0 +1,227 @@
+# -*- coding: UTF-8 -*-
+
+##############################################################################
+#                                                                            #
+# Copyright (c) 2007-2010 Bernd Kreuss <prof7bit@gmail.com>                  #
+#                                                                            #
+# This program is licensed under the GNU General Public License V3,          #
+# the full source code is included in the binary distribution.               #
+#                                                                            #
+# Included in the distribution are files from other open source projects:    #
+# - TOR Onion Router (c) The Tor Project, 3-clause-BSD                       #
+# - SocksiPy (c) Dan Haim, BSD Style License                                 #
+# - Gajim buddy status icons (c) The Gajim Team, GNU GPL                     #
+#                                                                            #
+##############################################################################
+
+
+# Headless TorChat. This runs the client library (tc_client) without
+# the wx GUI, for example as a long running service on a server without
+# a display or for benchmarking the client. Run it from within the src
+# directory like torchat.py, the optional first argument is the name of
+# the profile, exactly like it is for torchat.py:
+#
+#   python tc_daemon.py [profile]
+#
+# All events from the client library go to a callback sink. The sink
+# used by main() only writes them to the log and if the auto save folder
+# (option temp_files_custom_dir in section [files]) exists it accepts all
+# incoming files and saves them there, other programs can import this
+# module and use startClient() with their own CallbackSink subclass.
+#
+# This module must never import wx or tc_gui.
+
+import config
+import os
+import re
+import signal
+import threading
+import tc_client
+
+class CallbackSink(object):
+    """receives all callbacks from tc_client.BuddyList (the same callbacks
+    that tc_gui.MainWindow.callbackMessage() receives in the GUI) and
+    calls one method per callback type. Override the methods you need.
+    The methods are called from the client's network threads, they must
+    return quickly and must not block"""
+    def __init__(self):
+        self.handlers = {
+            tc_client.CB_TYPE_CHAT : self.onChatCallback,
+            tc_client.CB_TYPE_FILE : self.onFile,
+            tc_client.CB_TYPE_FILE_RESUMED : self.onFileResumed,
+            tc_client.CB_TYPE_OFFLINE_SENT : self.onOfflineSent,
+            tc_client.CB_TYPE_STATUS : self.onStatus,
+            tc_client.CB_TYPE_LIST_CHANGED : self.onListChanged,
+            tc_client.CB_TYPE_AVATAR : self.onAvatar,
+            tc_client.CB_TYPE_PROFILE : self.onProfile,
+            tc_client.CB_TYPE_REMOVE : self.onRemove,
+        }
+
+    def __call__(self, callback_type, callback_data):
+        try:
+            handler = self.handlers[callback_type]
+        except KeyError:
+            print "(1) CallbackSink: unknown callback type %s" % callback_type
+            return
+        handler(callback_data)
+
+    def onChatCallback(self, data):
+        buddy, message = data
+        self.onChat(buddy, message)
+
+    def onChat(self, buddy, message):
+        pass
+
+    def onFile(self, receiver):
+        # a FileReceiver does not work without somebody providing
+        # its callback function and closing it again when it is done,
+        # so if nobody wants to deal with incoming files we must
+        # politely refuse them.
+        print "(2) CallbackSink: refusing file %s from %s" % (receiver.file_name, receiver.buddy.address)
+        receiver.setCallbackFunction(self.onFileDataChange)
+        receiver.closeForced()
+
+    def onFileResumed(self, sender):
+        # an outgoing transfer from the last session, let it finish
+        print "(2) CallbackSink: resuming %s to %s" % (sender.file_name, sender.buddy.address)
+        sender.setCallbackFunction(self.onFileDataChange)
+
+    def onFileDataChange(self, total, complete, error_msg="", stats=None):
+        pass
+
+    def onOfflineSent(self, buddy):
+        pass
+
+    def onStatus(self, buddy):
+        pass
+
+    def onListChanged(self, data):
+        pass
+
+    def onAvatar(self, buddy):
+        pass
+
+    def onProfile(self, buddy):
+        pass
+
+    def onRemove(self, buddy):
+        pass
+
+
+class LogSink(CallbackSink):
+    """writes all events to the log"""
+    def onChat(self, buddy, message):
+        print "(1) message from %s: %s" % (buddy.address, message)
+
+    def onOfflineSent(self, buddy):
+        print "(1) offline messages sent to %s" % buddy.address
+
+    def onStatus(self, buddy):
+        print "(1) %s has status %i" % (buddy.address, buddy.status)
+
+    def onListChanged(self, data):
+        print "(1) buddy list changed"
+
+    def onProfile(self, buddy):
+        print "(1) %s has updated profile: %s" % (buddy.address, buddy.profile_name)
+
+    def onRemove(self, buddy):
+        print "(1) %s has been removed" % buddy.address
+
+
+class AutoAcceptSink(LogSink):
+    """accepts all incoming files and saves them in a sub folder per
+    buddy of folder, the same way the GUI's auto save does it"""
+    def __init__(self, folder):
+        LogSink.__init__(self)
+        self.folder = folder
+
+    def getFileNameSave(self, receiver):
+        buddy = receiver.buddy
+        if buddy.name != "":
+            buddy_dir = buddy.name + ' ' + buddy.address
+        else:
+            buddy_dir = buddy.address
+        path = os.path.join(self.folder, re.sub('[\/\\\:\*\?\"\<\>\|]+', '', buddy_dir))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        base, extension = os.path.splitext(receiver.file_name)
+        file_name = os.path.join(path, receiver.file_name)
+        counter = 1
+        while os.path.exists(file_name):
+            file_name = os.path.join(path, base + ' (renamed ' + str(counter) + ')' + extension)
+            counter += 1
+        return file_name
+
+    def onFile(self, receiver):
+        try:
+            file_name = self.getFileNameSave(receiver)
+        except OSError, e:
+            print "(1) AutoAcceptSink: cannot create folder: %s" % e
+            CallbackSink.onFile(self, receiver)
+            return
+        receiver.setFileNameSave(file_name)
+        if not receiver.file_handle_save:
+            print "(1) AutoAcceptSink: cannot save %s: %s" % (file_name, receiver.file_save_error)
+            CallbackSink.onFile(self, receiver)
+            return
+
+        print "(1) receiving %s from %s" % (file_name, receiver.buddy.address)
+        def onFileDataChange(total, complete, error_msg="", stats=None):
+            # we are responsible for closing it when it is done. Closing
+            # writes the rest of the file and moves it, this must not
+            # happen in the network thread that is calling us.
+            if complete == total:
+                print "(1) received %s" % file_name
+                threading.Thread(target=receiver.close).start()
+            elif complete == -1:
+                print "(1) receiving %s failed: %s" % (file_name, error_msg)
+                threading.Thread(target=receiver.close).start()
+        receiver.setCallbackFunction(onFileDataChange)
+
+
+def startClient(sink):
+    """open the listening port and start the client. Returns the
+    BuddyList or None if the port is not available"""
+    interface = config.get("client", "listen_interface")
+    port = config.getint("client", "listen_port")
+    print "(1) opening TorChat listener on %s:%s" % (interface, port)
+    listen_socket = tc_client.tryBindPort(interface, port)
+    if not listen_socket:
+        print "(0) %s:%s is already in use" % (interface, port)
+        return None
+    print "(1) TorChat is listening on %s:%s" % (interface, port)
+    return tc_client.BuddyList(sink, listen_socket)
+
+def main():
+    folder = config.getUserCustomDir()
+    if folder:
+        print "(1) incoming files will be saved in %s" % folder
+        bl = startClient(AutoAcceptSink(folder))
+    else:
+        bl = startClient(LogSink())
+    if not bl:
+        return
+
+    stop = threading.Event()
+    def onSignal(signum, frame):
+        print "(1) received signal %i, shutting down" % signum
+        stop.set()
+    signal.signal(signal.SIGINT, onSignal)
+    signal.signal(signal.SIGTERM, onSignal)
+
+    print "(0) TorChat is running headless as %s" % config.get("client", "own_hostname")
+    # Event.wait() without timeout would not wake up for the signals
+    while not stop.isSet():
+        stop.wait(1)
+
+    bl.stopClient() #this will also stop portable Tor
+
+    # the network threads don't all join properly (see
+    # MainWindow.exitProgram() in tc_gui.py), so do the same
+    # but without our own handler for the signal it will send
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    config.killProcess(os.getpid())
+
+if __name__ == "__main__":
+    main()
@@ -33,7 +33,6 @@ import tc_notification
 import string
 import math
 from imaplib import Flags
-from datetime import datetime
 lang = translations.lang_en
 tb = config.tb
 tb1 = config.tb1
@@ -511,7 +510,7 @@ class DlgEditContact(wx.Dialog):
         else:
             address_old = self.buddy.address
             offline_file_name_old = self.buddy.getOfflineFileName()
-            self.buddy.address = address
+            self.bl.setBuddyAddress(self.buddy, address)
             offline_file_name_new = self.buddy.getOfflineFileName()
             self.buddy.name = self.txt_name.GetValue()
             self.bl.save()
@@ -2100,10 +2099,11 @@ class AvatarDropTarget(BetterFileDropTarget):
 
 
 class FileTransferWindow(wx.Frame):
-    def __init__(self, main_window, buddy, file_name, receiver=None, is_zip_file=False):
+    def __init__(self, main_window, buddy, file_name, receiver=None, is_zip_file=False, sender=None):
         #if receiver is given (a FileReceiver instance) we initialize
         #a Receiver Window, else we initialize a sender window and
         #let the client library create us a FileSender instance
+        #(or use the given one if it was resumed after a restart)
         wx.Frame.__init__(self, main_window, -1)
         self.mw = main_window
         self.buddy = buddy
@@ -2117,18 +2117,21 @@ class FileTransferWindow(wx.Frame):
         self.error_msg = ""
         self.autosave = False
         self.alldone = False
-        self.bytesdiff = 0;
-        self.prevtime = datetime.now();
         self.transferrate = 0
+        self.eta = None
+        self.stats = None
         self.is_zip_file = is_zip_file
 
-        if not receiver:
+        if sender:
+            self.is_receiver = False
+            sender.setCallbackFunction(self.onDataChange)
+            self.transfer_object = sender
+        elif not receiver:
             self.is_receiver = False
             self.transfer_object = self.buddy.sendFile(self.file_name,
                                                        self.onDataChange)
         else:
             self.is_receiver = True
-            receiver.setCallbackFunction(self.onDataChange)
             self.transfer_object = receiver
             self.bytes_total = receiver.file_size
             self.file_name = file_name
@@ -2158,6 +2161,9 @@ class FileTransferWindow(wx.Frame):
             if self.autoSave():
                 self.btn_save.SetLabel(lang.DFT_AUTO_SAVE)
                 self.btn_save.Enable(False)
+            # only now, the blocks that have arrived meanwhile
+            # can then go directly into the auto save file
+            receiver.setCallbackFunction(self.onDataChange)
         else:
             self.chatMessage(lang.CHAT_SENDING_FILE % self.file_name)
                 
@@ -2210,6 +2216,18 @@ class FileTransferWindow(wx.Frame):
         # Append transfer rate
         text = "%s\n%.2f KB/s%s" % (text, self.transferrate, self.getETA())
         
+        # the sender also reports its send window and round trip time
+        # and how it shares the upload with other transfers
+        if self.stats and "window" in self.stats:
+            text = "%s\n%s" % (text, lang.DFT_WINDOW % (self.stats["window"] / 1024,
+                                                        self.stats["rtt"] * 1000))
+            if self.stats.get("transfers", 1) > 1:
+                text = "%s\n%s" % (text, lang.DFT_SHARED % (self.stats["transfers"] - 1))
+            if self.stats.get("upload_limit"):
+                text = "%s\n%s" % (text, lang.DFT_UPLOAD_LIMIT % (self.stats["upload_limit"] / 1024))
+            if self.stats.get("compression", 1) < 0.95:
+                text = "%s\n%s" % (text, lang.DFT_COMPRESSION % (self.stats["compression"] * 100))
+        
         
         try:
             # the client has no translation files,
@@ -2219,6 +2237,7 @@ class FileTransferWindow(wx.Frame):
                 "starting transfer" : lang.DFT_STARTING,
                 "transfer complete" : lang.DFT_COMPLETE,
                 "transfer aborted" : lang.DFT_ABORTED,
+                "file digest mismatch" : lang.DFT_DIGEST_ERROR,
                 "error" : lang.DFT_ERROR
             }[self.error_msg]
         except:
@@ -2262,41 +2281,32 @@ class FileTransferWindow(wx.Frame):
                 #self.btn_cancel.SetLabel(lang.BTN_CLOSE)
                 self.Close();
 
-    def onDataChange(self, total, complete, error_msg=""):
+    def onDataChange(self, total, complete, error_msg="", stats=None):
         #will be called from the FileSender/FileReceiver-object in the
         #protocol module to update gui (called from a non-GUI thread!)
-        
-        deltabytes = complete - self.bytes_complete
+        #not more often than 10 times per second (see ProgressReporter)
         
         self.bytes_total = total
         self.bytes_complete = complete
         self.error_msg = error_msg
-        
-        self.updateTransferStats(deltabytes)
+        if stats:
+            # (not all reports have all stats)
+            if self.stats:
+                self.stats.update(stats)
+            else:
+                self.stats = stats
+            if "rate" in stats:
+                self.transferrate = stats["rate"] / 1024.0
+                self.eta = stats["eta"]
 
         #we must use wx.Callafter to make calls into wx
         #because we are *NOT* in the context of the GUI thread here
         wx.CallAfter(self.updateOutput)
     
-    def updateTransferStats(self, bytesdiff):
-        self.bytesdiff += bytesdiff
-        now = datetime.now();
-        timedelta = now - self.prevtime
-        seconds = self.getTimeDeltaInSeconds(timedelta)
-        
-        if seconds > 2.5:
-            self.transferrate = (self.bytesdiff/1024)/seconds
-            self.bytesdiff = 0
-            self.prevtime = now
-    
-    def getTimeDeltaInSeconds(self, timedelta):
-        return timedelta.seconds + timedelta.microseconds/1E6
-    
     def getETA(self):
         text = ""
-        if self.transferrate > 0:
-            kilobytes = (self.bytes_total-self.bytes_complete)/1024
-            timetotal = kilobytes/self.transferrate
+        if self.eta is not None:
+            timetotal = self.eta
             
             seconds = int(math.floor(timetotal%60))
             minutes = int(math.floor((timetotal/60)%60))
@@ -2454,7 +2464,8 @@ class MainWindow(wx.Frame):
         )
         self.conns = []
         self.chat_windows = []
-        self.buddy_list = tc_client.BuddyList(self.callbackMessage, socket)
+        self.callback_queue = tc_client.CallbackQueue(self.onCallbackQueued)
+        self.buddy_list = tc_client.BuddyList(self.callback_queue.put, socket)
         
         self.updateTitle()
 
@@ -2536,87 +2547,75 @@ class MainWindow(wx.Frame):
         self.buddy_list.setStatus(status)
         self.taskbar_icon.showStatus(status)
 
+    def onCallbackQueued(self):
+        #called in the context of one of the connection threads
+        #when callbacks are waiting in the queue, they are all
+        #handled in the GUI thread by callbackMessage()
+        wx.CallAfter(self.callback_queue.drain, self.callbackMessage)
+
     def callbackMessage(self, callback_type, callback_data):
-        #we must always use wx.CallAfter() to interact with
-        #the GUI-Thread because this method will be called
-        #in the context of one of the connection threads
+        #this is called in the GUI thread (see CallbackQueue) for
+        #every callback from the client, one after the other, so
+        #a window that is created here will be in our lists
+        #already when the next callback is handled
 
         if callback_type == tc_client.CB_TYPE_CHAT:
             buddy, message = callback_data
             for window in self.chat_windows:
                 if window.buddy.address == buddy.address:
-                    wx.CallAfter(window.process, message)
+                    window.process(message)
                     return
             #no window found, so we create a new one
             hidden = config.getint("gui", "open_chat_window_hidden")
-            wx.CallAfter(ChatWindow, self, buddy, message, hidden)
-
-            #we let this thread block until the window
-            #shows up in our chat window list
-            found = False
-            while not found:
-                time.sleep(1)
-                for window in self.chat_windows:
-                    if window.buddy.address == buddy.address:
-                        found = True
-                        break
+            ChatWindow(self, buddy, message, hidden)
 
         if callback_type == tc_client.CB_TYPE_OFFLINE_SENT:
             buddy = callback_data
             for window in self.chat_windows:
                 if window.buddy.address == buddy.address:
-                    wx.CallAfter(window.notifyOfflineSent)
+                    window.notifyOfflineSent()
                     return
 
             hidden = config.getint("gui", "open_chat_window_hidden")
-            wx.CallAfter(ChatWindow, self, buddy, "", hidden, notify_offline_sent=True)
+            ChatWindow(self, buddy, "", hidden, notify_offline_sent=True)
 
         if callback_type == tc_client.CB_TYPE_FILE:
             #this happens when an incoming file transfer was initialized
-            #we must now create a FileTransferWindow and return its
-            #event handler method to the caller
+            #we must now create a FileTransferWindow which will give
+            #the receiver its event handler method
             receiver = callback_data
-            buddy = receiver.buddy
-            file_name = receiver.file_name
+            FileTransferWindow(self, receiver.buddy, receiver.file_name, receiver)
 
-            #we cannot get return values from wx.CallAfter() calls
-            #so we have to CallAfter() and then just wait for
-            #the TransferWindow to appear.
-            wx.CallAfter(FileTransferWindow, self,
-                                             buddy,
-                                             file_name,
-                                             receiver)
+        if callback_type == tc_client.CB_TYPE_FILE_RESUMED:
+            #an unfinished outgoing file transfer from the last
+            #session has been resumed, it needs a FileTransferWindow
+            sender = callback_data
+            FileTransferWindow(self, sender.buddy, sender.file_name, None, False, sender)
 
         if callback_type == tc_client.CB_TYPE_STATUS:
             # this is called when the status of one of the
             # buddies has changed. callback_data is the Buddy instance
-            wx.CallAfter(self.gui_bl.onBuddyStatusChanged, callback_data)
+            self.gui_bl.onBuddyStatusChanged(callback_data)
 
         if callback_type == tc_client.CB_TYPE_AVATAR:
             # this is called when the avatar of one of the
             # buddy has changed. callback_data is the Buddy instance
-            wx.CallAfter(self.gui_bl.onBuddyAvatarChanged, callback_data)
+            self.gui_bl.onBuddyAvatarChanged(callback_data)
 
         if callback_type == tc_client.CB_TYPE_PROFILE:
             # this is called when the profile of one of the
             # buddy has changed. callback_data is the Buddy instance
-            wx.CallAfter(self.gui_bl.onBuddyProfileChanged, callback_data)
+            self.gui_bl.onBuddyProfileChanged(callback_data)
 
         if callback_type == tc_client.CB_TYPE_LIST_CHANGED:
-            try:
-                wx.CallAfter(self.gui_bl.onListChanged)
-            except:
-                # might be too early and there is no gui_bl object yet.
-                # But this does not matter because gui_bl itself will
-                # call this at least once after initialization.
-                pass
+            self.gui_bl.onListChanged()
 
         if callback_type == tc_client.CB_TYPE_REMOVE:
             # called when the client is removing the buddy from the list
             # callback_data is the buddy
             for window in self.chat_windows:
                 if window.buddy.address == callback_data.address:
-                    wx.CallAfter(window.Close)
+                    window.Close()
 
     def onPrefs(self, evt):
         dialog = dlg_settings.Dialog(self)
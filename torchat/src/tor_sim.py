@@ -0,0 +1,382 @@
+# -*- coding: UTF-8 -*-
+
+##############################################################################
+#                                                                            #
+# Copyright (c) 2007-2010 Bernd Kreuss <prof7bit@gmail.com>                  #
+#                                                                            #
+# This program is licensed under the GNU General Public License V3,          #
+# the full source code is included in the binary distribution.               #
+#                                                                            #
+# Included in the distribution are files from other open source projects:    #
+# - TOR Onion Router (c) The Tor Project, 3-clause-BSD                       #
+# - SocksiPy (c) Dan Haim, BSD Style License                                 #
+# - Gajim buddy status icons (c) The Gajim Team, GNU GPL                     #
+#                                                                            #
+##############################################################################
+
+
+# A stand-in for the Tor SOCKS proxy, for testing and benchmarking
+# TorChat on one machine without Tor and without internet. It accepts
+# SOCKS4 and SOCKS4a requests just like Tor does and connects hidden
+# service addresses (*.onion) to local TorChat listeners. To make it
+# behave a bit more like a real Tor circuit it can add latency, limit
+# the bandwidth, delay or refuse new connections and randomly drop
+# established connections.
+#
+# Example: two TorChat profiles listening on ports 11009 and 11010 and
+# both configured with tor_server_socks_port = 9050:
+#
+#   python tor_sim.py -p 9050 -o aaaaaaaaaaaaaaaa=11009 \
+#                     -o bbbbbbbbbbbbbbbb=11010 -l 300 -b 50000
+#
+# It can also be used from other python code:
+#
+#   sim = tor_sim.TorSimulator(9050, {"aaaaaaaaaaaaaaaa" : 11009})
+#   sim.start()
+#   ...
+#   sim.stop()
+#
+# This is a development tool, it does not import config (which would
+# read torchat.ini and redirect the output) and it is not part of the
+# binary distribution.
+
+import sys
+import time
+import random
+import signal
+import socket
+import struct
+import threading
+import optparse
+import collections
+
+SOCKS_GRANTED = "\x00\x5a" + "\x00" * 6
+SOCKS_REJECTED = "\x00\x5b" + "\x00" * 6
+
+def log(level, text):
+    if level <= TorSimulator.log_level:
+        sys.stdout.write("(%i) %s\n" % (level, text))
+        sys.stdout.flush()
+
+
+class Pipe(threading.Thread):
+    """forwards the data from one socket to another with the latency and
+    the bandwidth limit of the simulator. Received chunks are delivered
+    latency seconds after they were received, sending is paced so that
+    the average rate does not exceed bandwidth bytes per second. Not more
+    than buffer_size bytes are held back, after that the reading stops
+    and the sender will feel the back pressure, just like with Tor"""
+    def __init__(self, sim, link, source, destination):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sim = sim
+        self.link = link
+        self.source = source
+        self.destination = destination
+        self.queue = collections.deque()
+        self.queued = 0
+        self.condition = threading.Condition()
+        self.eof = False
+        self.start()
+
+    def run(self):
+        # a second thread reads the socket, this one only delivers
+        reader = threading.Thread(target=self.read)
+        reader.daemon = True
+        reader.start()
+        next_send = time.time()
+        try:
+            while True:
+                self.condition.acquire()
+                while not self.queue and not self.eof:
+                    self.condition.wait()
+                if not self.queue:
+                    self.condition.release()
+                    break
+                due, data = self.queue.popleft()
+                self.queued -= len(data)
+                self.condition.notify()
+                self.condition.release()
+
+                now = time.time()
+                if due > now:
+                    time.sleep(due - now)
+                if self.sim.bandwidth:
+                    next_send = max(next_send, time.time())
+                    wait = next_send - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                    next_send += float(len(data)) / self.sim.bandwidth
+                self.destination.sendall(data)
+        except socket.error:
+            pass
+        self.link.close()
+
+    def read(self):
+        try:
+            while True:
+                data = self.source.recv(self.sim.chunk_size)
+                if not data:
+                    break
+                self.put(data)
+        except socket.error:
+            pass
+        self.condition.acquire()
+        self.eof = True
+        self.condition.notify()
+        self.condition.release()
+
+    def put(self, data):
+        due = time.time() + self.sim.getLatency()
+        self.condition.acquire()
+        while self.queued > self.sim.buffer_size:
+            self.condition.wait()
+        if self.queue:
+            # chunks can not overtake each other
+            due = max(due, self.queue[-1][0])
+        self.queue.append((due, data))
+        self.queued += len(data)
+        self.condition.notify()
+        self.condition.release()
+
+
+class Link(object):
+    """one client connection through the simulated Tor network"""
+    def __init__(self, sim, name, client, target):
+        self.sim = sim
+        self.name = name
+        self.client = client
+        self.target = target
+        self.closed = False
+        self.lock = threading.Lock()
+        self.drop_timer = None
+        if sim.drop_rate:
+            # the time until a circuit breaks is exponentially distributed
+            lifetime = random.expovariate(sim.drop_rate)
+            self.drop_timer = threading.Timer(lifetime, self.drop)
+            self.drop_timer.daemon = True
+            self.drop_timer.start()
+        Pipe(sim, self, client, target)
+        Pipe(sim, self, target, client)
+
+    def drop(self):
+        log(1, "dropping connection to %s" % self.name)
+        self.sim.dropped += 1
+        self.close()
+
+    def close(self):
+        self.lock.acquire()
+        closed, self.closed = self.closed, True
+        self.lock.release()
+        if closed:
+            return
+        if self.drop_timer:
+            self.drop_timer.cancel()
+        for sock in [self.client, self.target]:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        self.sim.removeLink(self)
+
+
+class TorSimulator(threading.Thread):
+    """the SOCKS4/4a server. onions maps the 16 character hidden service
+    names (without .onion) to the port of the local TorChat listener.
+    latency and jitter are seconds added to each direction, bandwidth
+    is bytes per second per direction and connection (0 = unlimited),
+    connect_delay is the time it takes to build a circuit, fail_rate
+    is the probability that a connection request fails and drop_rate
+    is the average number of drops per second and connection"""
+    log_level = 1
+
+    def __init__(self, port, onions, latency=0, jitter=0, bandwidth=0,
+                 connect_delay=0, fail_rate=0, drop_rate=0, interface="127.0.0.1"):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.onions = onions
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.connect_delay = connect_delay
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.chunk_size = 4096
+        self.buffer_size = 262144
+        self.links = set()
+        self.links_lock = threading.Lock()
+        self.connected = 0
+        self.failed = 0
+        self.dropped = 0
+        self.running = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((interface, port))
+        self.socket.listen(20)
+
+    def getLatency(self):
+        if self.jitter:
+            return max(0, random.gauss(self.latency, self.jitter))
+        return self.latency
+
+    def run(self):
+        log(1, "SOCKS server listening on %s:%i" % self.socket.getsockname())
+        while self.running:
+            try:
+                client, address = self.socket.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self.handleClient, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def readRequest(self, client):
+        """read the SOCKS4 request and return (host, port). For SOCKS4a
+        the host is the name that follows the user id"""
+        data = ""
+        while len(data) < 8 or data.count("\x00", 8) < 1:
+            chunk = client.recv(1024)
+            if not chunk:
+                raise socket.error("connection closed during request")
+            data += chunk
+        version, command, port = struct.unpack(">BBH", data[:4])
+        if version != 4 or command != 1:
+            raise socket.error("not a SOCKS4 connect request")
+        ip = socket.inet_ntoa(data[4:8])
+        userid, rest = data[8:].split("\x00", 1)
+        if ip.startswith("0.0.0.") and ip != "0.0.0.0":
+            # SOCKS4a, the host name follows
+            while not "\x00" in rest:
+                chunk = client.recv(1024)
+                if not chunk:
+                    raise socket.error("connection closed during request")
+                rest += chunk
+            host, rest = rest.split("\x00", 1)
+        else:
+            host = ip
+        return host, port, rest
+
+    def resolve(self, host, port):
+        if host.endswith(".onion"):
+            name = host[:-6]
+            if name in self.onions:
+                return "127.0.0.1", self.onions[name]
+            return None
+        return host, port
+
+    def handleClient(self, client):
+        try:
+            host, port, early_data = self.readRequest(client)
+        except socket.error, e:
+            log(1, "bad request: %s" % e)
+            client.close()
+            return
+
+        target_address = self.resolve(host, port)
+        if self.connect_delay:
+            time.sleep(self.connect_delay)
+
+        target = None
+        if target_address and random.random() >= self.fail_rate:
+            try:
+                target = socket.create_connection(target_address)
+            except socket.error, e:
+                log(2, "connection to %s:%i failed: %s" % (host, port, e))
+
+        if not target:
+            log(2, "rejecting connection to %s:%i" % (host, port))
+            self.failed += 1
+            try:
+                client.sendall(SOCKS_REJECTED)
+            except socket.error:
+                pass
+            client.close()
+            return
+
+        log(2, "connected to %s:%i" % (host, port))
+        self.connected += 1
+        try:
+            client.sendall(SOCKS_GRANTED)
+            if early_data:
+                target.sendall(early_data)
+        except socket.error:
+            client.close()
+            target.close()
+            return
+        link = Link(self, "%s:%i" % (host, port), client, target)
+        self.links_lock.acquire()
+        self.links.add(link)
+        self.links_lock.release()
+
+    def removeLink(self, link):
+        self.links_lock.acquire()
+        self.links.discard(link)
+        self.links_lock.release()
+
+    def stop(self):
+        self.running = False
+        try:
+            # wake up the accept() in run()
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        self.links_lock.acquire()
+        links = list(self.links)
+        self.links_lock.release()
+        for link in links:
+            link.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-p", "--port", type="int", default=9050,
+                      help="SOCKS port to listen on [%default]")
+    parser.add_option("-o", "--onion", action="append", default=[], metavar="NAME=PORT",
+                      help="connect NAME.onion to the listener on local PORT (can be repeated)")
+    parser.add_option("-l", "--latency", type="float", default=0, metavar="MS",
+                      help="one way latency in milliseconds [%default]")
+    parser.add_option("-j", "--jitter", type="float", default=0, metavar="MS",
+                      help="standard deviation of the latency in milliseconds [%default]")
+    parser.add_option("-b", "--bandwidth", type="int", default=0, metavar="BYTES",
+                      help="bytes per second per connection and direction, 0 is unlimited [%default]")
+    parser.add_option("-c", "--connect-delay", type="float", default=0, metavar="MS",
+                      help="time to build a circuit in milliseconds [%default]")
+    parser.add_option("-f", "--fail-rate", type="float", default=0, metavar="P",
+                      help="probability that a new connection is refused [%default]")
+    parser.add_option("-d", "--drop-rate", type="float", default=0, metavar="N",
+                      help="average drops per connection per hour [%default]")
+    parser.add_option("-v", "--verbose", action="count", default=1,
+                      help="more log output")
+    options, args = parser.parse_args()
+
+    onions = {}
+    for mapping in options.onion:
+        try:
+            name, port = mapping.split("=")
+            onions[name.replace(".onion", "")] = int(port)
+        except ValueError:
+            parser.error("invalid onion mapping '%s'" % mapping)
+
+    TorSimulator.log_level = options.verbose
+    sim = TorSimulator(options.port, onions,
+                       latency=options.latency / 1000.0,
+                       jitter=options.jitter / 1000.0,
+                       bandwidth=options.bandwidth,
+                       connect_delay=options.connect_delay / 1000.0,
+                       fail_rate=options.fail_rate,
+                       drop_rate=options.drop_rate / 3600.0)
+    def onSignal(signum, frame):
+        sim.stop()
+    signal.signal(signal.SIGTERM, onSignal)
+    sim.start()
+    try:
+        while sim.isAlive():
+            sim.join(1)
+    except KeyboardInterrupt:
+        sim.stop()
+    log(1, "connected %i, failed %i, dropped %i" % (sim.connected, sim.failed, sim.dropped))
+
+if __name__ == "__main__":
+    main()
@@ -115,6 +115,7 @@ DFT_STARTING = u"starting transfer"
 DFT_ABORTED = u"transfer aborted"
 DFT_COMPLETE = u"transfer complete"
 DFT_ERROR = u"error"
+DFT_DIGEST_ERROR = u"the file has changed during the transfer, it was discarded"
 
 #settings dialaog
 DSET_TITLE = u"TorChat configuration"
@@ -238,5 +239,13 @@ DFT_ETA_DAYS = u"%id, %ih, %im and %is"
 DFT_ETA_HOURS = u"%ih, %im and %is"
 DFT_ETA_MINS = u"%i minutes and %i seconds"
 DFT_ETA_SECS = u"%i seconds"
+DFT_WINDOW = u"window %i KB, round trip %i ms"
+DFT_SHARED = u"sharing the upload with %i other transfers"
+DFT_UPLOAD_LIMIT = u"upload limited to %i KB/s"
+DFT_COMPRESSION = u"compressed to %i%%"
+DSET_FILES_SEP_UPLOAD_TITLE = u"Upload"
+DSET_FILES_UPLOAD_LIMIT = u"Upload limit for all file transfers in KB/s (0 = no limit)"
+DSET_FILES_UPLOAD_LIMIT_BUDDY = u"Upload limit for each contact in KB/s (0 = no limit)"
+DSET_FILES_COMPRESSION_LEVEL = u"Compression of sent files (0 = off, 1 = fastest, 9 = smallest)"
 MPOP_BLOCK_CONTACT = u"Block contact"
 MPOP_UNBLOCK_CONTACT = u"Unblock contact"
\ No newline at end of file